@@ -5,6 +5,10 @@ export function sendMessage(sender, message) {
   return axios.post(`${API_HOST}/chat`, { sender, message });
 }
 
+export function streamMessage(message) {
+  return new EventSource(`${API_HOST}/chat_stream?query=${encodeURIComponent(message)}`);
+}
+
 export function uploadDoc(title, text) {
   const newText = text.replace(/\s/g, '');
   return axios.post(`${API_HOST}/doc`, { title, text: newText });
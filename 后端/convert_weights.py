@@ -0,0 +1,24 @@
+import argparse
+import json
+import logging
+
+from models.mmap_weights import convert_to_mmap
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    """
+    python convert_weights.py --config config_v1.json
+    One-time conversion of the mrc and rerank checkpoints to memory-mapped weights,
+    server.py picks them up automatically (and falls back to pytorch_model.bin when they are stale).
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default='config_v1.json', type=str)
+    args = parser.parse_args()
+
+    config = json.load(open(args.config, 'r'))
+    for section in ['mrc', 'rerank']:
+        convert_to_mmap(config[section]['model_name_or_path'])
@@ -5,5 +5,25 @@
 # @Email : weiranbit@163.com
 # @File : __init__.py
 
-from .baidu_creeper import creeper_v1
-from .spider import crawl as creeper_v2
\ No newline at end of file
+from .cache import configure_crawl_cache
+
+
+# 爬虫模块依赖 bs4/lxml/requests, 第一次调用时再导入, 不拖慢 server 启动
+def creeper_v1(*args, **kwargs):
+    from .baidu_creeper import creeper_v1
+    return creeper_v1(*args, **kwargs)
+
+
+def creeper_v1_iter(*args, **kwargs):
+    from .baidu_creeper import creeper_v1_iter
+    return creeper_v1_iter(*args, **kwargs)
+
+
+def creeper_v2(*args, **kwargs):
+    from .spider import crawl
+    return crawl(*args, **kwargs)
+
+
+def creeper_v2_iter(*args, **kwargs):
+    from .spider import crawl_iter
+    return crawl_iter(*args, **kwargs)
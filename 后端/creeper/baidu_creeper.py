@@ -13,6 +13,7 @@ import requests
 from bs4 import BeautifulSoup
  
 from creeper import url2io
+from creeper.cache import cached_fetch
 
 tpl_list = [
     'se_com_default',  # 默认其他网站
@@ -26,6 +27,18 @@ api1 = url2io.API('HMTEF2G9SzySmZ7DAWN0Rw')
 api2 = url2io.API('yCnOWq_vTfSd7svSDH5f9Q')
 
 
+def _fetch_serp_html(url, headers):
+    req = urllib.request.Request(url, headers=headers)
+    page = urllib.request.urlopen(req)
+    return page.read().decode('utf8', 'ignore')
+
+
+def fetch_article(link):
+    """url2io 正文抽取, 结果按 url 缓存"""
+    return cached_fetch('page', 'url2io:' + link,
+                        lambda: api1.article(url=link, fields=['text']))
+
+
 def creeper(word, num=5):
     '''
 
@@ -139,26 +152,20 @@ def creeper(word, num=5):
     return links, titles, abstracts, examples, contents
 
 
-def creeper_v1(word, num=5):
+def creeper_v1_iter(word, num=5):
     '''
+    Yield each document as soon as its content has been fetched.
 
     :param word: 爬取关键字
     :param num: 要爬取的网页数量
     :return:
-        titles: 文章标题
-        abstracts:  摘要
-        links:  链接
-        contents:  主要内容
+        examples: dict with title, abstract, source_link, content and doc_tokens
     '''
     st = time.time()
 
-    titles = []  # 文章标题
-    abstracts = []  # 摘要
-    links = []  # 链接
-    contents = []  # 主要内容
-
+    count = 0
     for pn in range(0, 10):
-        if len(contents) >= num:
+        if count >= num:
             break
 
         url = 'http://www.baidu.com.cn/s?wd=' + urllib.parse.quote(word) + '&pn={:d}'.format(
@@ -174,9 +181,9 @@ def creeper_v1(word, num=5):
 
         while True:
             print('Some error, try again...')
-            req = urllib.request.Request(url, headers=headers)
-            page = urllib.request.urlopen(req)
-            soup = BeautifulSoup(page.read().decode('utf8', 'ignore'), 'lxml')
+            html = cached_fetch('serp', url, lambda: _fetch_serp_html(url, headers),
+                                validate=lambda html: 'content_left' in html)
+            soup = BeautifulSoup(html, 'lxml')
             content = soup.find('div', {'id': 'content_left'})
             if content is not None:
                 break
@@ -211,8 +218,7 @@ def creeper_v1(word, num=5):
                 content = None
                 try:
                     t1 = time.time()
-                    content = api1.article(url=link,
-                                           fields=['text'])
+                    content = fetch_article(link)
                     t2 = time.time()
                     print("Time cost: {:f}".format(t2 - t1))
                 except Exception as e:
@@ -225,34 +231,35 @@ def creeper_v1(word, num=5):
                 else:
                     content = content['text'].replace(
                         '\r', '').replace('\n', '')
-                    links.append(link)
-                    titles.append(tag.text.replace("\"", ""))
                     if abstract is None:
                         abstract = content[:100]
-                    abstracts.append(abstract)
-                    contents.append(content)
-
-            if len(contents) >= num:
+                    count += 1
+                    yield {
+                        'question_id': count,
+                        'question': word,
+                        'title': tag.text.replace("\"", ""),
+                        'abstract': abstract,
+                        'source_link': link,
+                        'content': content,
+                        'doc_tokens': list(jieba.cut(content))
+                    }
+
+            if count >= num:
                 break
 
     ed = time.time()
     print("Total time cost: {:f}".format(ed - st))
-    examples = []
-    indexs = range(1,len(links)+1)
-    for index, link, title, abstract, content in zip(indexs, links, titles, abstracts, contents) :
-        example = {
-            'question_id': index,
-            'question': word,
-            'title': title,
-            'abstract': abstract,
-            'source_link': link,
-            'content': content,
-            'doc_tokens': list(jieba.cut(content))
-        }
-        examples.append(example)
-
-
-    return examples
+
+
+def creeper_v1(word, num=5):
+    '''
+
+    :param word: 爬取关键字
+    :param num: 要爬取的网页数量
+    :return:
+        examples: list of dict, see creeper_v1_iter
+    '''
+    return list(creeper_v1_iter(word, num))
 
 
 # if __name__ == '__main__':
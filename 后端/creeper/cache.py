@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+""" Persistent cache of search result pages and extracted page content. """
+
+import logging
+import os
+
+from utils.cache import SingleFlight, SqliteCache
+
+logger = logging.getLogger(__name__)
+
+_crawl_cache = None
+
+
+class CrawlCache(object):
+    """
+    Two compressed on-disk levels, both evicted by total size:
+    - serp: search results keyed by keyword, short ttl
+    - page: page text keyed by url, long ttl
+    Concurrent fetches of the same key are deduplicated.
+    """
+
+    def __init__(self, cache_dir, serp_ttl=600, page_ttl=604800,
+                 serp_max_bytes=64 * 1024 * 1024, page_max_bytes=1024 * 1024 * 1024):
+        self.levels = {
+            'serp': SqliteCache(os.path.join(cache_dir, 'serp.sqlite'), ttl=serp_ttl,
+                                max_bytes=serp_max_bytes, compress=True),
+            'page': SqliteCache(os.path.join(cache_dir, 'page.sqlite'), ttl=page_ttl,
+                                max_bytes=page_max_bytes, compress=True),
+        }
+        self._flight = SingleFlight()
+
+    def fetch(self, level, key, fn, validate=bool):
+        """Return the cached value of `key`, or run `fn` and cache its result if `validate` accepts it."""
+        cache = self.levels[level]
+        value = cache.get(key)
+        if value is not None:
+            return value
+
+        def _fetch():
+            value = fn()
+            if validate(value):
+                cache.set(key, value)
+            return value
+        return self._flight.do((level, key), _fetch)
+
+
+def configure_crawl_cache(config):
+    """
+    config:
+    {
+        "cache_dir": string,
+        "serp_ttl": seconds, "page_ttl": seconds,
+        "serp_max_bytes": int, "page_max_bytes": int
+    }
+    """
+    global _crawl_cache
+    _crawl_cache = CrawlCache(**config)
+    logger.info("Crawl cache at %s", config['cache_dir'])
+
+
+def cached_fetch(level, key, fn, validate=bool):
+    """`CrawlCache.fetch` on the configured cache, or just `fn()` when caching is off."""
+    if _crawl_cache is None:
+        return fn()
+    return _crawl_cache.fetch(level, key, fn, validate)
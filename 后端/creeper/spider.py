@@ -8,13 +8,15 @@ Created Time: 2019-09-26 16:56
 """
 import json
 import time
-from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 import logging
 import jieba
 import requests
 from lxml import etree
 
+from creeper.cache import cached_fetch
+
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
@@ -28,6 +30,11 @@ headers = {
 
 
 def crawl_baidu_search(keyword, num=5):
+    return cached_fetch('serp', 'baidu:{}:{}'.format(num, keyword),
+                        lambda: _crawl_baidu_search(keyword, num))
+
+
+def _crawl_baidu_search(keyword, num):
 
     url = "https://www.baidu.com/s?wd=" + keyword
     response = requests.get(url, headers=headers)
@@ -64,6 +71,10 @@ def crawl_baidu_search(keyword, num=5):
 
 
 def crawl_baidu_cache_page(url):
+    return cached_fetch('page', url, lambda: _crawl_baidu_cache_page(url))
+
+
+def _crawl_baidu_cache_page(url):
     response = requests.get(url, headers=headers)
     response.encoding = 'gbk'
     content_tree = etree.HTML(response.text)
@@ -81,19 +92,30 @@ def crawl_baidu_cache_page(url):
     return valid_content
 
 
-def crawl(keyword):
+def _crawl_search_data(each_search_data):
+    each_search_data['content'] = crawl_baidu_cache_page(each_search_data['baidu_cache_link'])
+    return each_search_data
+
+
+def crawl_iter(keyword):
+    """
+    Yield each search result as soon as its page content has been fetched
+    (completion order, use `question_id` for the search rank).
+    """
     search_data = crawl_baidu_search(keyword)
-    results = []
-    pool = Pool(processes=3)
-    for each_search_data in search_data:
-        results.append(pool.apply_async(crawl_baidu_cache_page, args=(each_search_data['baidu_cache_link'],)))
-    pool.close()
-    pool.join()
-    for each_search_data, result in zip(search_data, results):
-        time.sleep(1)
-        each_search_data['content'] = result.get()
-        each_search_data['doc_tokens'] = list(jieba.cut(each_search_data['content']))
-    return search_data
+    # threads rather than processes: the fetches are network bound and the
+    # server must not fork while its model threads are running.
+    pool = ThreadPool(processes=3)
+    try:
+        for each_search_data in pool.imap_unordered(_crawl_search_data, search_data):
+            each_search_data['doc_tokens'] = list(jieba.cut(each_search_data['content']))
+            yield each_search_data
+    finally:
+        pool.terminate()
+
+
+def crawl(keyword):
+    return sorted(crawl_iter(keyword), key=lambda x: x['question_id'])
 
 
 # if __name__ == '__main__':
@@ -36,10 +36,7 @@ import json
 import urllib
 from urllib import request
 import time
-from collections import Iterable
-import importlib
-
-importlib.reload(sys)
+from collections.abc import Iterable
 
 headers = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
@@ -6,8 +6,6 @@ import json
 from collections import defaultdict
 import sys
 import common
-reload(sys)
-sys.setdefaultencoding("utf-8")
 
 
 class BLEU(object):
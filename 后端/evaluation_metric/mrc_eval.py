@@ -3,6 +3,8 @@
 This module computes evaluation metrics for DuReader dataset.
 """
 
+from __future__ import print_function
+
 import argparse
 import itertools
 import json
@@ -108,7 +110,7 @@ def read_file(file_name, is_ref=False):
                 obj = json.loads(line.strip())
             except ValueError:
                 #raise ValueError("Every line of data should be legal json, in line %s" % str(line_num))
-                print >> sys.stderr, ValueError("Every line of data should be legal json, in line %s" % str(line_num))
+                print(ValueError("Every line of data should be legal json, in line %s" % str(line_num)), file=sys.stderr)
                 continue
             data_check(obj)
             qid = obj['question_id']
@@ -124,18 +126,21 @@ def read_file(file_name, is_ref=False):
                     results[qid]['entity_answers'][i] = normalize(e)
     return results
 
-def main(args):
+def compute_metrics(pred_file, ref_file, ab=1.0):
+    """
+    Score pred_file against ref_file, returns the leaderboard style metrics dict.
+    """
     err = None
     metrics = {}
     bleu4, rouge_l = 0.0, 0.0
-    alpha = args.ab
-    beta = args.ab
+    alpha = ab
+    beta = ab
     bleu_eval = BLEUWithBonus(4, alpha=alpha, beta=beta)
     rouge_eval = RougeL(alpha=alpha, beta=beta, gamma=1.2)
     try:
-        pred_result = read_file(args.pred_file)
-        ref_result = read_file(args.ref_file, is_ref=True)
-        for qid, results in ref_result.iteritems():
+        pred_result = read_file(pred_file)
+        ref_result = read_file(ref_file, is_ref=True)
+        for qid, results in ref_result.items():
             cand_result = pred_result.get(qid, {})
             #pred_answers = cand_result.get('answers', [EMPTY])[0]
             pred_answers = cand_result.get('answers', [])
@@ -182,7 +187,12 @@ def main(args):
             {'type': 'BOTH', 'name': 'ROUGE-L', 'value': round(rouge_l* 100, 2)},
             {'type': 'BOTH', 'name': 'BLEU-4', 'value': round(bleu4 * 100, 2)},
             ]
-    print json.dumps(metrics, ensure_ascii=False).encode('utf8')
+    return metrics
+
+
+def main(args):
+    metrics = compute_metrics(args.pred_file, args.ref_file, args.ab)
+    print(json.dumps(metrics, ensure_ascii=False))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -6,8 +6,6 @@ import json
 import numpy as np
 from collections import defaultdict
 import sys
-reload(sys)
-sys.setdefaultencoding("utf-8")
 
 class RougeL(object):
     def __init__(self, alpha=1.0, beta=1.0, gamma=1.2):
@@ -0,0 +1,53 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from models.onnx_backend import ONNX_NAME, OnnxModel, check_onnx, export_onnx
+from mrc import mrc_MODEL_CLASSES
+from rerank import rerank_MODEL_CLASSES
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODELS = {
+    'mrc': (mrc_MODEL_CLASSES, ['start_logits', 'end_logits']),
+    'rerank': (rerank_MODEL_CLASSES, ['logits']),
+}
+
+if __name__ == "__main__":
+    """
+    python export_onnx.py --config config_v1.json --model mrc --check
+    then set "model_type": "bert_onnx" in the same section of the config.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default='config_v1.json', type=str)
+    parser.add_argument("--model", default='mrc', type=str, choices=list(MODELS))
+    parser.add_argument("--opset_version", default=10, type=int)
+    parser.add_argument("--check", action='store_true',
+                        help="Compare the ONNX Runtime outputs with the torch outputs after export")
+    parser.add_argument("--atol", default=1e-3, type=float,
+                        help="Max absolute difference accepted by --check")
+    args = parser.parse_args()
+
+    section = json.load(open(args.config, 'r'))[args.model]
+    model_dir = section['model_name_or_path']
+    model_classes, output_names = MODELS[args.model]
+    config_class, model_class, _ = model_classes['bert']
+
+    config = config_class.from_pretrained(model_dir)
+    model = model_class.from_pretrained(model_dir, config=config)
+    onnx_file = os.path.join(model_dir, ONNX_NAME)
+    export_onnx(model, onnx_file, output_names, opset_version=args.opset_version,
+                max_seq_length=section['max_seq_length'])
+
+    if args.check:
+        max_seq_length = section['max_seq_length']
+        max_diff = check_onnx(model, OnnxModel(onnx_file),
+                              lengths=sorted({16, max_seq_length // 2, max_seq_length}))
+        logger.info("max abs diff between torch and onnxruntime: %.6f (atol %.6f)", max_diff, args.atol)
+        if max_diff > args.atol:
+            sys.exit(1)
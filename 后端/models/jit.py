@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+""" TorchScript inference backend: one traced graph per sequence-length bucket. """
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+
+import torch
+from transformers import WEIGHTS_NAME
+
+logger = logging.getLogger(__name__)
+
+TRACED_DIR = 'torchscript'
+
+
+def checkpoint_fingerprint(model_dir):
+    """Identify the checkpoint the artifacts were traced from, so a retrained model is retraced."""
+    weights = os.path.join(model_dir, WEIGHTS_NAME)
+    stat = os.stat(weights)
+    return {'weights_size': stat.st_size, 'weights_mtime': int(stat.st_mtime), 'torch': torch.__version__}
+
+
+def _optimize(traced):
+    # torch.jit.freeze / optimize_for_inference only exist in newer torch (>=1.8 / 1.9),
+    # on torch 1.2 the traced graph is used as is.
+    if hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+    if hasattr(torch.jit, 'optimize_for_inference'):
+        traced = torch.jit.optimize_for_inference(traced)
+    return traced
+
+
+def _dummy_inputs(batch_size, length, device):
+    input_ids = torch.ones((batch_size, length), dtype=torch.long, device=device)
+    attention_mask = torch.ones((batch_size, length), dtype=torch.long, device=device)
+    token_type_ids = torch.zeros((batch_size, length), dtype=torch.long, device=device)
+    return (input_ids, attention_mask, token_type_ids)
+
+
+class TracedModel(object):
+    """
+    Drop-in replacement of the eager model for inference.
+
+    Inputs are right-padded to the smallest bucket that fits them and run
+    through the graph traced for that bucket. With token_level=True the
+    outputs (start/end logits) are cut back to the input length.
+    """
+
+    def __init__(self, modules, token_level=True):
+        self.modules = modules
+        self.buckets = sorted(modules)
+        self.token_level = token_level
+
+    @classmethod
+    def load_or_trace(cls, model_dir, build_model, buckets, device, token_level=True, traced_dir=TRACED_DIR):
+        """
+        Load the artifacts saved under model_dir/traced_dir, tracing the missing
+        or stale buckets with the eager model returned by build_model().
+        """
+        traced_dir = os.path.join(model_dir, traced_dir)
+        meta_file = os.path.join(traced_dir, 'meta.json')
+        fingerprint = checkpoint_fingerprint(model_dir)
+
+        meta = {}
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+        if meta.get('fingerprint') != fingerprint:
+            meta = {'fingerprint': fingerprint, 'buckets': []}
+
+        modules = {}
+        model = None
+        for length in sorted(buckets):
+            path = os.path.join(traced_dir, 'model_{}.pt'.format(length))
+            if length in meta['buckets'] and os.path.exists(path):
+                modules[length] = torch.jit.load(path, map_location=device)
+                continue
+            if model is None:
+                model = build_model()
+                model.eval()
+                os.makedirs(traced_dir, exist_ok=True)
+            logger.info("Tracing %s for sequence length %d", model.__class__.__name__, length)
+            with torch.no_grad():
+                # check_inputs with other batch sizes: the batch dimension must stay dynamic
+                traced = torch.jit.trace(model, _dummy_inputs(2, length, device),
+                                         check_inputs=[_dummy_inputs(1, length, device),
+                                                       _dummy_inputs(3, length, device)])
+            traced = _optimize(traced)
+            torch.jit.save(traced, path)
+            modules[length] = traced
+            meta['buckets'] = sorted(set(meta['buckets']) | {length})
+
+        if model is not None:
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+        logger.info("TorchScript backend ready, buckets: %s", sorted(modules))
+        return cls(modules, token_level=token_level)
+
+    def _bucket(self, length):
+        for bucket in self.buckets:
+            if bucket >= length:
+                return bucket
+        raise ValueError("Sequence length {} exceeds the largest traced bucket {}".format(length, self.buckets[-1]))
+
+    def __call__(self, input_ids, attention_mask=None, token_type_ids=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        length = input_ids.size(1)
+        bucket = self._bucket(length)
+        if bucket > length:
+            pad = (0, bucket - length)
+            input_ids = torch.nn.functional.pad(input_ids, pad)
+            attention_mask = torch.nn.functional.pad(attention_mask, pad)
+            token_type_ids = torch.nn.functional.pad(token_type_ids, pad)
+        with torch.no_grad():
+            outputs = self.modules[bucket](input_ids, attention_mask, token_type_ids)
+        if not isinstance(outputs, tuple):
+            outputs = (outputs,)
+        if self.token_level:
+            outputs = tuple(output[:, :length] for output in outputs)
+        return outputs
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        for module in self.modules.values():
+            module.to(device)
+        return self
+
+    def share_memory(self):
+        for module in self.modules.values():
+            module.share_memory()
+        return self
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+""" Memory-mapped checkpoint weights: a flat tensor file plus a JSON index. """
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import torch
+from transformers import WEIGHTS_NAME, PreTrainedModel
+
+from .jit import checkpoint_fingerprint
+
+logger = logging.getLogger(__name__)
+
+MMAP_NAME = 'weights.mmap'
+INDEX_NAME = 'weights.json'
+ALIGNMENT = 64
+
+# the modules of a BERT model whose constructor draws random weights
+_RANDOM_INIT_MODULES = (torch.nn.Linear, torch.nn.Embedding, torch.nn.LayerNorm)
+_skip_init_lock = threading.Lock()
+
+
+def convert_to_mmap(model_dir):
+    """One-time conversion of model_dir/pytorch_model.bin to weights.mmap + weights.json."""
+    state_dict = torch.load(os.path.join(model_dir, WEIGHTS_NAME), map_location='cpu')
+    index = {'fingerprint': checkpoint_fingerprint(model_dir), 'tensors': {}}
+    offset = 0
+    with open(os.path.join(model_dir, MMAP_NAME), 'wb') as writer:
+        for name, tensor in state_dict.items():
+            array = tensor.contiguous().numpy()
+            padding = -offset % ALIGNMENT
+            writer.write(b'\0' * padding)
+            offset += padding
+            index['tensors'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            writer.write(array.tobytes())
+            offset += array.nbytes
+    with open(os.path.join(model_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    logger.info("Wrote %d tensors (%d bytes) to %s", len(state_dict), offset, os.path.join(model_dir, MMAP_NAME))
+
+
+def has_mmap_weights(model_dir):
+    """True if model_dir has converted weights matching its current pytorch_model.bin."""
+    index_file = os.path.join(model_dir, INDEX_NAME)
+    if not os.path.exists(index_file) or not os.path.exists(os.path.join(model_dir, MMAP_NAME)):
+        return False
+    with open(index_file) as f:
+        fingerprint = json.load(f)['fingerprint']
+    if fingerprint != checkpoint_fingerprint(model_dir):
+        logger.warning("%s is older than %s, run convert_weights.py again", INDEX_NAME, WEIGHTS_NAME)
+        return False
+    return True
+
+
+def load_mmap_state_dict(model_dir):
+    """
+    Tensors backed by the mapped file: pages are read on first touch and shared
+    (copy-on-write) between every process mapping the same checkpoint.
+    """
+    with open(os.path.join(model_dir, INDEX_NAME)) as f:
+        index = json.load(f)
+    buffer = np.memmap(os.path.join(model_dir, MMAP_NAME), dtype=np.uint8, mode='c')
+    state_dict = {}
+    for name, meta in index['tensors'].items():
+        dtype = np.dtype(meta['dtype'])
+        count = int(np.prod(meta['shape'])) if meta['shape'] else 1
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=meta['offset']).reshape(meta['shape'])
+        state_dict[name] = torch.from_numpy(array)
+    return state_dict
+
+
+def _prune_heads_only(model):
+    # PreTrainedModel.init_weights without the random init
+    if model.config.pruned_heads:
+        model.prune_heads(model.config.pruned_heads)
+
+
+@contextlib.contextmanager
+def _skip_random_init():
+    """
+    Build modules with uninitialized weights: the layers' reset_parameters and
+    PreTrainedModel.init_weights (model.apply(_init_weights)) are turned off meanwhile.
+    """
+    with _skip_init_lock:
+        reset_parameters = [(cls, cls.__dict__['reset_parameters']) for cls in _RANDOM_INIT_MODULES]
+        init_weights = PreTrainedModel.init_weights
+        try:
+            for cls, _ in reset_parameters:
+                cls.reset_parameters = lambda self: None
+            PreTrainedModel.init_weights = _prune_heads_only
+            yield
+        finally:
+            for cls, method in reset_parameters:
+                cls.reset_parameters = method
+            PreTrainedModel.init_weights = init_weights
+
+
+def load_mmap_model(model_class, model_dir, config):
+    """
+    Build model_class and point its parameters at the mapped tensors, no copy.
+    The model is built without its random init, every weight is replaced right after.
+    """
+    with _skip_random_init():
+        model = model_class(config)
+    own = model.state_dict(keep_vars=True)
+    state_dict = load_mmap_state_dict(model_dir)
+    missing = set(own) - set(state_dict)
+    if missing:
+        raise ValueError("{} misses weights: {}".format(os.path.join(model_dir, MMAP_NAME), sorted(missing)))
+    for name, tensor in state_dict.items():
+        if name in own:
+            own[name].data = tensor
+    model.eval()
+    model.mmap_weights = True  # already shared through the page cache, see Demo.share_memory
+    return model
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+""" ONNX Runtime inference backend for the MRC and rerank BERT models. """
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+ONNX_NAME = 'model.onnx'
+INPUT_NAMES = ['input_ids', 'attention_mask', 'token_type_ids']
+
+
+def export_onnx(model, output_file, output_names, opset_version=10, max_seq_length=128):
+    """Export an eager model to ONNX with dynamic batch and sequence axes."""
+    model.eval()
+    device = next(model.parameters()).device
+    dummy = (torch.ones((2, max_seq_length), dtype=torch.long, device=device),
+             torch.ones((2, max_seq_length), dtype=torch.long, device=device),
+             torch.zeros((2, max_seq_length), dtype=torch.long, device=device))
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in INPUT_NAMES}
+    for name in output_names:
+        dynamic_axes[name] = {0: 'batch', 1: 'sequence'} if name.endswith('_logits') else {0: 'batch'}
+    with torch.no_grad():
+        torch.onnx.export(model, dummy, output_file,
+                          input_names=INPUT_NAMES,
+                          output_names=output_names,
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version,
+                          do_constant_folding=True)
+    logger.info("Exported %s to %s", model.__class__.__name__, output_file)
+
+
+class OnnxModel(object):
+    """
+    Runs an exported graph in ONNX Runtime behind the eager model's call
+    signature, so mrc_predict / rerank_predict don't need to know the backend.
+    Select it with model_type "bert_onnx" in the mrc / rerank config section.
+    """
+
+    def __init__(self, onnx_file):
+        self.onnx_file = onnx_file
+        self._pid = None
+        self._sess = None
+
+    @classmethod
+    def from_pretrained(cls, model_name_or_path, *inputs, **kwargs):
+        """Same call as the transformers models; config/from_tf are ignored."""
+        onnx_file = os.path.join(model_name_or_path, ONNX_NAME)
+        if not os.path.exists(onnx_file):
+            raise ValueError("{} not found, export it first with export_onnx.py".format(onnx_file))
+        return cls(onnx_file)
+
+    def _session(self):
+        # ORT thread pools don't survive fork: every (prefork) worker opens its own session
+        if self._sess is None or self._pid != os.getpid():
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.intra_op_num_threads = torch.get_num_threads()
+            self._sess = ort.InferenceSession(self.onnx_file, options)
+            self._pid = os.getpid()
+        return self._sess
+
+    def __call__(self, input_ids, attention_mask=None, token_type_ids=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        feeds = {name: tensor.cpu().numpy() for name, tensor in
+                 zip(INPUT_NAMES, (input_ids, attention_mask, token_type_ids))}
+        outputs = self._session().run(None, feeds)
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        if torch.device(device).type != 'cpu':
+            logger.warning("OnnxModel runs on the CPU execution provider, ignoring device %s", device)
+        return self
+
+    def share_memory(self):
+        return self
+
+
+def check_onnx(model, onnx_model, lengths=(16, 64, 128), batch_size=3):
+    """Max absolute difference between the torch and the ONNX outputs on random inputs."""
+    model.eval()
+    device = next(model.parameters()).device
+    max_diff = 0.0
+    for length in lengths:
+        input_ids = torch.randint(1, model.config.vocab_size, (batch_size, length), dtype=torch.long)
+        attention_mask = torch.ones((batch_size, length), dtype=torch.long)
+        attention_mask[0, length // 2:] = 0  # one padded row
+        token_type_ids = torch.zeros((batch_size, length), dtype=torch.long)
+        token_type_ids[:, length // 4:] = 1
+        with torch.no_grad():
+            expected = model(input_ids.to(device), attention_mask=attention_mask.to(device),
+                             token_type_ids=token_type_ids.to(device))
+        actual = onnx_model(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        for e, a in zip(expected, actual):
+            diff = (e.cpu().float() - a.float()).abs().max().item()
+            logger.info("length %d: max abs diff %.6f", length, diff)
+            max_diff = max(max_diff, diff)
+    return max_diff
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+""" Dynamic int8 quantization of the BERT linear layers for CPU serving. """
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+
+import torch
+from torch import nn
+
+from .jit import checkpoint_fingerprint
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_DIR = 'quantized'
+QUANTIZED_NAME = 'model_int8.bin'
+
+
+def quantize_dynamic(model):
+    """Quantize the weights of every nn.Linear to int8, activations are quantized on the fly."""
+    if not hasattr(torch.quantization, 'quantize_dynamic'):
+        raise ValueError("Dynamic quantization needs torch>=1.3, found {}".format(torch.__version__))
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized(model_dir, model_class, config):
+    """
+    Return the int8 model of the checkpoint in model_dir (CPU only).
+    The quantized state dict is cached under model_dir/quantized and rebuilt
+    when the fp32 weights change.
+    """
+    quantized_dir = os.path.join(model_dir, QUANTIZED_DIR)
+    weights_file = os.path.join(quantized_dir, QUANTIZED_NAME)
+    meta_file = os.path.join(quantized_dir, 'meta.json')
+    fingerprint = checkpoint_fingerprint(model_dir)
+
+    meta = {}
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+    if meta.get('fingerprint') == fingerprint and os.path.exists(weights_file):
+        logger.info("Loading quantized model from %s", weights_file)
+        # rebuild the quantized module structure, then fill in the cached int8 weights
+        model = quantize_dynamic(model_class(config))
+        model.load_state_dict(torch.load(weights_file, map_location='cpu'))
+        return model
+
+    logger.info("Quantizing %s to int8", model_dir)
+    model = quantize_dynamic(model_class.from_pretrained(model_dir, config=config))
+    os.makedirs(quantized_dir, exist_ok=True)
+    torch.save(model.state_dict(), weights_file)
+    with open(meta_file, 'w') as f:
+        json.dump({'fingerprint': fingerprint}, f)
+    return model
@@ -5,8 +5,20 @@
 # @Email : weiranbit@163.com
 # @File : __init__.py
 
-from .run_duqa import MODEL_CLASSES as mrc_MODEL_CLASSES
-from .run_duqa import predict as mrc_predict # for server
-from .run_duqa import evaluate as mrc_evaluate
-from .run_duqa import set_seed, to_list
-from .run_duqa import main as mrc_train
\ No newline at end of file
+from .predict_duqa import MODEL_CLASSES as mrc_MODEL_CLASSES
+from .predict_duqa import predict as mrc_predict # for server
+from .predict_duqa import predict_logits as mrc_predict_logits
+from .predict_duqa import set_seed, to_list
+from .utils_duqa import tokenize_doc
+
+
+# run_duqa pulls in the training-only modules (checkpoints, eval worker, feature store, ...):
+# imported on first use, so the server does not load them
+def mrc_evaluate(*args, **kwargs):
+    from .run_duqa import evaluate
+    return evaluate(*args, **kwargs)
+
+
+def mrc_train():
+    from .run_duqa import main
+    return main()
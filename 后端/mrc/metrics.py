@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+""" ROUGE-L / BLEU-4 of MRC predictions, with evaluation_metric/mrc_eval.py. """
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import sys
+from io import open
+
+logger = logging.getLogger(__name__)
+
+# evaluation_metric is a folder of scripts, not a package
+EVALUATION_METRIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'evaluation_metric')
+
+
+def write_references(input_file, ref_file):
+    """The answers of a DuReader json file in the mrc_eval reference format, one line per question."""
+    seen = set()
+    with open(input_file, 'r', encoding='utf-8') as reader, open(ref_file, 'w', encoding='utf-8') as ref:
+        for line in reader:
+            example = json.loads(line)
+            if example['question_id'] in seen:
+                continue
+            seen.add(example['question_id'])
+            ref.write(json.dumps({
+                'question_id': example['question_id'],
+                'question_type': example.get('question_type', 'DESCRIPTION'),
+                'answers': example.get('answers') or example.get('fake_answer', []),
+                'yesno_answers': example.get('yesno_answers', []),
+                'entity_answers': example.get('entity_answers', [[]]),
+                'source': example.get('source', 'search'),
+            }, ensure_ascii=False) + '\n')
+    return ref_file
+
+
+def score_predictions(predictions, ref_file, output_dir):
+    """{metric name: value} of {question_id: answer text} against ref_file (see write_references)."""
+    if EVALUATION_METRIC_DIR not in sys.path:
+        sys.path.insert(0, EVALUATION_METRIC_DIR)
+    from mrc_eval import compute_metrics
+
+    pred_file = os.path.join(output_dir, 'pred.json')
+    with open(pred_file, 'w', encoding='utf-8') as writer:
+        for qid, text in predictions.items():
+            writer.write(json.dumps({'question_id': int(qid) if str(qid).isdigit() else qid,
+                                     'answers': [text], 'yesno_answers': []}, ensure_ascii=False) + '\n')
+    metrics = compute_metrics(pred_file, ref_file)
+    if metrics['errorCode']:
+        raise ValueError(metrics['errorMsg'])
+    return {item['name']: item['value'] for item in metrics['data']}
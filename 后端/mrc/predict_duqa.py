@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+""" Prediction with a fine-tuned Duqa model: what the server imports, without the training modules. """
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import random
+
+import numpy as np
+import torch
+from transformers import BertConfig, BertTokenizer
+
+from models import BertForBaiduQA_Answer_Selection
+from models.onnx_backend import OnnxModel
+from utils.batching import pad_sequences
+
+from .utils_duqa import (RawResult, convert_examples_to_features,
+                         convert_output, read_baidu_examples_pred)
+
+logger = logging.getLogger(__name__)
+
+MODEL_CLASSES = {
+    'bert': (BertConfig, BertForBaiduQA_Answer_Selection, BertTokenizer),
+    'bert_onnx': (BertConfig, OnnxModel, BertTokenizer)  # inference only, see export_onnx.py
+}
+
+def set_seed(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.n_gpu > 0:
+        torch.cuda.manual_seed_all(args.seed)
+
+
+def to_list(tensor):
+    return tensor.detach().cpu().tolist()
+
+
+def predict_features(args, tokenizer, raw_data, doc_cache=None):
+    """Read the raw examples of a predict request and build their feature windows."""
+    examples = read_baidu_examples_pred(raw_data, is_training=False)
+    features = convert_examples_to_features(
+        examples=examples,
+        tokenizer=tokenizer,
+        max_seq_length=args.max_seq_length,
+        doc_stride=args.doc_stride,
+        max_query_length=args.max_query_length,
+        is_training=False,
+        doc_cache=doc_cache,
+        pad_to_max_length=False
+    )
+    return examples, features
+
+
+def predict_logits(args, model, features):
+    """
+    Run the forward pass over feature windows and return one
+    (start_logits, end_logits) pair of CPU tensors per window, in input order.
+    The windows may come from different requests (see serving.DynamicBatcher).
+    Windows are batched by length and each batch is only padded to its longest window.
+    """
+    args.predict_batch_size = args.per_gpu_predict_batch_size * max(1, args.n_gpu)
+    order = sorted(range(len(features)), key=lambda i: len(features[i].input_ids), reverse=True)
+
+    all_logits = [None] * len(features)
+    model.eval()
+    for start in range(0, len(order), args.predict_batch_size):
+        indices = order[start:start + args.predict_batch_size]
+        batch = (pad_sequences([features[i].input_ids for i in indices]),
+                 pad_sequences([features[i].input_mask for i in indices]),
+                 pad_sequences([features[i].segment_ids for i in indices]))
+        batch = tuple(t.to(args.device) for t in batch)
+        with torch.no_grad():
+            inputs = {'input_ids':      batch[0],
+                      'attention_mask': batch[1],
+                      'token_type_ids': batch[2]
+                      }
+            outputs = model(**inputs)
+
+        for j, i in enumerate(indices):
+            length = len(features[i].input_ids)
+            # stay tensors, convert_output decodes spans in torch
+            all_logits[i] = (outputs[0][j][:length].cpu(), outputs[1][j][:length].cpu())
+    return all_logits
+
+
+def predict(args, model, tokenizer, raw_data, forward_fn=None, doc_cache=None):
+    """
+    forward_fn: optional callable mapping a list of features to their logits,
+    e.g. `DynamicBatcher.submit` to share forward passes between requests.
+    Defaults to running `predict_logits` inline.
+    doc_cache: optional cache of the question independent document features,
+    see `utils_duqa.get_doc_features`.
+    """
+    examples, features = predict_features(args, tokenizer, raw_data, doc_cache=doc_cache)
+
+    # Predict!
+    logger.info("***** Running prediction *****")
+    logger.info("  Num examples = %d", len(features))
+    if forward_fn is None:
+        all_logits = predict_logits(args, model, features)
+    else:
+        all_logits = forward_fn(features)
+    assert len(all_logits) == len(features)
+
+    all_results = []
+    for feature, (start_logits, end_logits) in zip(features, all_logits):
+        result = RawResult(unique_id    = int(feature.unique_id),
+                           start_logits = start_logits,
+                           end_logits   = end_logits)
+        all_results.append(result)
+
+    all_predictions, all_nbest_json = convert_output(examples, features, all_results,
+                                                    args.n_best_size, args.max_answer_length,
+                                                    args.do_lower_case, args.verbose_logging)
+    
+    return all_predictions, all_nbest_json
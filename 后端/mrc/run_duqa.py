@@ -4,56 +4,73 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
+import copy
 import glob
+import itertools
 import logging
 import os
-import random
 import sys
 
-import numpy as np
 import torch
-from tensorboardX import SummaryWriter
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
+from torch.utils.data import (DataLoader, IterableDataset, RandomSampler,
                               TensorDataset)
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
-from transformers import (WEIGHTS_NAME, AdamW, BertConfig, BertTokenizer,
-                          WarmupLinearSchedule)
-
-from models import BertForBaiduQA_Answer_Selection
-
+from transformers import WEIGHTS_NAME, AdamW, WarmupLinearSchedule
+
+from utils.batching import BucketBatchSampler, LengthSortedSampler, trim_batch
+from utils.checkpoint import (AsyncCheckpointWriter, find_checkpoint,
+                              load_training_state, model_snapshot,
+                              set_rng_state, training_snapshot)
+from utils.eval_worker import EvalWorker
+from utils.feature_store import (feature_tensors, has_feature_extra,
+                                 has_feature_store, load_feature_extra,
+                                 load_feature_store, store_dir,
+                                 write_feature_store)
+from utils.streaming import JsonlStream, list_shards
+from utils.tokenization import fast_tokenizer
+
+from .metrics import score_predictions, write_references
+from .predict_duqa import MODEL_CLASSES, set_seed
 from .utils_duqa import (RawResult, convert_examples_to_features,
-                         convert_output, read_baidu_examples,
-                         read_baidu_examples_pred, write_predictions)
+                         decoding_table, feature_columns,
+                         features_from_decoding_table, read_baidu_examples,
+                         stream_features, write_predictions)
 
 logger = logging.getLogger(__name__)
 
-MODEL_CLASSES = {
-    'bert': (BertConfig, BertForBaiduQA_Answer_Selection, BertTokenizer)
-}
-
-def set_seed(args):
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    if args.n_gpu > 0:
-        torch.cuda.manual_seed_all(args.seed)
-
-
-def to_list(tensor):
-    return tensor.detach().cpu().tolist()
-
 
 def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     if args.local_rank in [-1, 0]:
+        from tensorboardX import SummaryWriter  # training only, keep it out of the server import path
         tb_writer = SummaryWriter()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    streaming = isinstance(train_dataset, IterableDataset)
+    train_sampler = None
+    if streaming:
+        # shuffled and sharded per rank / worker by the stream itself, the workers build the windows
+        train_dataloader = DataLoader(train_dataset, batch_size=args.train_batch_size,
+                                      num_workers=args.preprocess_workers)
+    elif args.bucket_size > 0:
+        # batches of windows of similar length, trimmed to their longest window in the loop
+        train_sampler = BucketBatchSampler(train_dataset.tensors[1].sum(dim=1), args.train_batch_size,
+                                           bucket_size=args.bucket_size, seed=args.seed)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler)
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
 
-    if args.max_steps > 0:
+    if streaming:
+        if args.max_steps <= 0:
+            raise ValueError("--streaming needs --max_steps, a stream has no length")
+        t_total = args.max_steps
+        # the stream never ends: every epoch takes the same number of batches on every rank
+        num_epochs = max(1, int(args.num_train_epochs))
+        batches_per_epoch = (t_total + num_epochs - 1) // num_epochs * args.gradient_accumulation_steps
+        train_batches = iter(train_dataloader)
+    elif args.max_steps > 0:
         t_total = args.max_steps
         args.num_train_epochs = args.max_steps // (len(train_dataloader) // args.gradient_accumulation_steps) + 1
     else:
@@ -67,6 +84,10 @@ def train(args, train_dataset, model, tokenizer):
         ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = WarmupLinearSchedule(optimizer, warmup_steps=args.warmup_steps, t_total=t_total)
+    resume_state = None
+    if args.resume_from:
+        resume_state = load_training_state(find_checkpoint(args.resume_from, args.output_dir, 'checkpoint-step-'),
+                                           model, optimizer, scheduler)
     if args.fp16:
         try:
             from apex import amp
@@ -86,7 +107,8 @@ def train(args, train_dataset, model, tokenizer):
 
     # Train!
     logger.info("***** Running training *****")
-    logger.info("  Num examples = %d", len(train_dataset))
+    if not streaming:
+        logger.info("  Num examples = %d", len(train_dataset))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
     logger.info("  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size)
     logger.info("  Total train batch size (w. parallel, distributed & accumulation) = %d",
@@ -96,14 +118,53 @@ def train(args, train_dataset, model, tokenizer):
 
     global_step = 0
     tr_loss, logging_loss = 0.0, 0.0
+    start_epoch, skip_batches = 0, 0
+    if resume_state is not None:
+        global_step = resume_state['global_step']
+        tr_loss, logging_loss = resume_state['tr_loss'], resume_state['logging_loss']
+        # continue right after the last batch of the checkpoint
+        start_epoch, skip_batches = resume_state['epoch'], resume_state['step'] + 1
+        if streaming:
+            train_batches = itertools.islice(train_batches, start_epoch * batches_per_epoch, None)
+    checkpoint_writer, eval_worker = None, None
+    if args.local_rank in [-1, 0]:
+        # the eval worker below must see every step checkpoint before it is pruned
+        wait_for_eval = args.local_rank == -1 and args.evaluate_during_training
+        keep = args.keep_checkpoints
+        if keep and args.eval_all_checkpoints:
+            logger.warning("--eval_all_checkpoints evaluates every step checkpoint, --keep_checkpoints is ignored")
+            keep = 0
+        checkpoint_writer = AsyncCheckpointWriter(prefix='checkpoint-step-', keep=keep,
+                                                  wait_for_eval=wait_for_eval)
+    if args.local_rank == -1 and args.evaluate_during_training:  # Only evaluate when single GPU otherwise metrics may not average well
+        # the step checkpoints are evaluated in another process as they are written, training goes on
+        if args.save_steps <= 0:
+            raise ValueError("--evaluate_during_training evaluates the step checkpoints, set --save_steps")
+        eval_worker = EvalWorker(evaluate_checkpoint, args, tokenizer, tb_writer.logdir,
+                                 prefix='checkpoint-step-', start_step=global_step)
     model.zero_grad()
     train_iterator = trange(int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0])
     set_seed(args)  # Added here for reproductibility (even between python 2 and 3)
     for epoch_idx, epoch in tqdm(enumerate(train_iterator), desc='training epoches'):
-        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
+        if epoch_idx < start_epoch:
+            continue
+        if hasattr(train_sampler, 'set_epoch'):
+            train_sampler.set_epoch(epoch_idx)  # reshuffle, the same way on every process
+        if resume_state is not None:
+            torch.set_rng_state(resume_state['epoch_rng_state'])  # RandomSampler: same order as the interrupted epoch
+        epoch_rng_state = torch.get_rng_state()
+        epoch_iterator = tqdm(itertools.islice(train_batches, batches_per_epoch) if streaming else train_dataloader,
+                              total=batches_per_epoch if streaming else None,
+                              desc="Iteration", disable=args.local_rank not in [-1, 0])
         for step, batch in tqdm(enumerate(epoch_iterator), desc='training batches'):
+            if resume_state is not None:
+                if step < skip_batches:
+                    continue
+                set_rng_state(resume_state['rng'])
+                resume_state = None
             model.train()
-            batch = tuple(t.to(args.device) for t in batch)
+            batch = trim_batch(batch)
+            batch = tuple(t.to(args.device).long() for t in batch)
             inputs = {'input_ids':       batch[0],
                       'attention_mask':  batch[1], 
                       'token_type_ids':  batch[2],  
@@ -134,56 +195,65 @@ def train(args, train_dataset, model, tokenizer):
 
                 if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
                     # Log metrics
-                    if args.local_rank == -1 and args.evaluate_during_training:  # Only evaluate when single GPU otherwise metrics may not average well
-                        results = evaluate(args, model, tokenizer)
-                        for key, value in results.items():
-                            tb_writer.add_scalar('eval_{}'.format(key), value, global_step)
                     tb_writer.add_scalar('lr', scheduler.get_lr()[0], global_step)
                     tb_writer.add_scalar('loss', (tr_loss - logging_loss)/args.logging_steps, global_step)
                     logging_loss = tr_loss
 
-                # if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
-                #     # Save model checkpoint
-                #     output_dir = os.path.join(args.output_dir, 'checkpoint-{}'.format(global_step))
-                #     if not os.path.exists(output_dir):
-                #         os.makedirs(output_dir)
-                #     model_to_save = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
-                #     model_to_save.save_pretrained(output_dir)
-                #     torch.save(args, os.path.join(output_dir, 'training_args.bin'))
-                #     logger.info("Saving model checkpoint to %s", output_dir)
+                if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
+                    # Save a resumable checkpoint, written in the background from a CPU copy
+                    model_to_save = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
+                    files = training_snapshot(model_to_save, optimizer, scheduler,
+                                              global_step=global_step, epoch=epoch_idx, step=step,
+                                              tr_loss=tr_loss, logging_loss=logging_loss,
+                                              epoch_rng_state=epoch_rng_state)
+                    files['training_args.bin'] = copy.copy(args)
+                    checkpoint_writer.save(os.path.join(args.output_dir, 'checkpoint-step-{}'.format(global_step)),
+                                           files, config=model_to_save.config)
 
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
+        if resume_state is not None:
+            # the checkpoint was taken on the last batch of its epoch
+            set_rng_state(resume_state['rng'])
+            resume_state = None
         if args.max_steps > 0 and global_step > args.max_steps:
             train_iterator.close()
             break
 
         if args.local_rank in [-1, 0]:
             # Save model checkpoint by epoch
-            output_dir = os.path.join(args.output_dir, 'checkpoint-{}'.format(epoch_idx))
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
             model_to_save = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
-            model_to_save.save_pretrained(output_dir)
-            torch.save(args, os.path.join(output_dir, 'training_args.bin'))
-            logger.info("Saving model checkpoint to %s", output_dir)
+            files = model_snapshot(model_to_save)
+            files['training_args.bin'] = copy.copy(args)
+            checkpoint_writer.save(os.path.join(args.output_dir, 'checkpoint-{}'.format(epoch_idx)),
+                                   files, config=model_to_save.config)
 
     if args.local_rank in [-1, 0]:
         tb_writer.close()
+        checkpoint_writer.close()
+    if eval_worker is not None:
+        eval_worker.close()
 
     return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, prefix=""):
-    dataset, examples, features = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True)
+def evaluate(args, model, tokenizer, prefix="", eval_data=None):
+    """
+    Write the dev set predictions to args.output_dir and return them ({question_id: answer}).
+    eval_data: the (dataset, examples, features) of load_and_cache_examples, to reuse them.
+    """
+    if eval_data is None:
+        eval_data = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True)
+    dataset, examples, features = eval_data
 
     if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
         os.makedirs(args.output_dir)
     
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(dataset) if args.local_rank == -1 else DistributedSampler(dataset)
+    # Batch windows of similar length together, each batch is trimmed to its longest window below
+    eval_sampler = LengthSortedSampler(dataset.tensors[1].sum(dim=1).tolist()) if args.local_rank == -1 else DistributedSampler(dataset)
     eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
     # Eval!
@@ -193,7 +263,8 @@ def evaluate(args, model, tokenizer, prefix=""):
     all_results = []
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
         model.eval()
-        batch = tuple(t.to(args.device) for t in batch)
+        batch = trim_batch(batch)
+        batch = tuple(t.to(args.device).long() for t in batch)
         with torch.no_grad():
             inputs = {'input_ids':      batch[0],
                       'attention_mask': batch[1],
@@ -206,68 +277,34 @@ def evaluate(args, model, tokenizer, prefix=""):
             eval_feature = features[example_index.item()]
             unique_id = int(eval_feature.unique_id)
             result = RawResult(unique_id    = unique_id,
-                                start_logits = to_list(outputs[0][i]),
-                                end_logits   = to_list(outputs[1][i]))     
+                                start_logits = outputs[0][i].cpu(),
+                                end_logits   = outputs[1][i].cpu())     
             all_results.append(result)
 
     output_prediction_file = os.path.join(args.output_dir, "predictions_{}.json".format(prefix))
     output_nbest_file = os.path.join(args.output_dir, "nbest_predictions_{}.json".format(prefix))
-    write_predictions(examples, features, all_results, args.n_best_size,
-                    args.max_answer_length, args.do_lower_case, output_prediction_file,
-                    output_nbest_file, args.verbose_logging)
-    return 0
+    return write_predictions(examples, features, all_results, args.n_best_size,
+                             args.max_answer_length, args.do_lower_case, output_prediction_file,
+                             output_nbest_file, args.verbose_logging)
 
 
-def predict(args, model, tokenizer, raw_data):
-    predict_examples = read_baidu_examples_pred(raw_data, is_training=False)
-    predict_features = convert_examples_to_features(
-        examples=predict_examples,
-        tokenizer=tokenizer,
-        max_seq_length=args.max_seq_length,
-        doc_stride=args.doc_stride,
-        max_query_length=args.max_query_length,
-        is_training=False
-    )
-    all_input_ids = torch.tensor([f.input_ids for f in predict_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in predict_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in predict_features], dtype=torch.long)
-    all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
-    dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)   
-
-    args.predict_batch_size = args.per_gpu_predict_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    predict_sampler = SequentialSampler(dataset) if args.local_rank == -1 else DistributedSampler(dataset)
-    predict_dataloader = DataLoader(dataset, sampler=predict_sampler, batch_size=args.predict_batch_size)
+_eval_data = None
 
-    # Predict!
-    logger.info("***** Running prediction *****")
-    logger.info("  Num examples = %d", len(dataset))
-    logger.info("  Batch size = %d", args.predict_batch_size)
-    all_results = []
-    for batch in tqdm(predict_dataloader, desc="Predicting"):
-        model.eval()
-        batch = tuple(t.to(args.device) for t in batch)
-        with torch.no_grad():
-            inputs = {'input_ids':      batch[0],
-                      'attention_mask': batch[1],
-                      'token_type_ids': batch[2]
-                      }
-            example_indices = batch[3]
-            outputs = model(**inputs)
 
-        for i, example_index in enumerate(example_indices):
-            eval_feature = predict_features[example_index.item()]
-            unique_id = int(eval_feature.unique_id)
-            result = RawResult(unique_id    = unique_id,
-                                start_logits = to_list(outputs[0][i]),
-                                end_logits   = to_list(outputs[1][i]))     
-            all_results.append(result)
-    
-    all_predictions, all_nbest_json = convert_output(predict_examples, predict_features, all_results,
-                                                    args.n_best_size, args.max_answer_length,
-                                                    args.do_lower_case, args.verbose_logging)
-    
-    return all_predictions, all_nbest_json
+def evaluate_checkpoint(args, checkpoint_dir, tokenizer, global_step):
+    """ROUGE-L / BLEU-4 of a step checkpoint on the dev set, run by the utils.eval_worker process."""
+    global _eval_data
+    eval_args = copy.copy(args)
+    eval_args.output_dir = os.path.join(args.output_dir, 'eval')
+    os.makedirs(eval_args.output_dir, exist_ok=True)
+    if _eval_data is None:
+        # loaded once from the dev set store (written on the first run), reused for every checkpoint
+        _eval_data = load_and_cache_examples(eval_args, tokenizer, evaluate=True, output_examples=True)
+        write_references(args.predict_file, os.path.join(eval_args.output_dir, 'ref.json'))
+    model = MODEL_CLASSES[args.model_type][1].from_pretrained(checkpoint_dir)
+    model.to(args.device)
+    predictions = evaluate(eval_args, model, tokenizer, prefix=str(global_step), eval_data=_eval_data)
+    return score_predictions(predictions, os.path.join(eval_args.output_dir, 'ref.json'), eval_args.output_dir)
 
 
 def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=False):
@@ -280,9 +317,17 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
         'dev' if evaluate else 'train',
         list(filter(None, args.model_name_or_path.split('/'))).pop(),
         str(args.max_seq_length)))
-    if os.path.exists(cached_features_file) and not args.overwrite_cache and not output_examples:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
+    cached_features_dir = store_dir(cached_features_file)
+    columns = feature_columns(tokenizer)
+    examples, features = None, None
+    # the dev set store also holds what write_predictions needs (stores written before it are rebuilt)
+    if has_feature_store(cached_features_dir) and not args.overwrite_cache and \
+            (not output_examples or has_feature_extra(cached_features_dir, 'decoding')):
+        logger.info("Loading features from cached file %s", cached_features_dir)
+        if output_examples:
+            window_columns = load_feature_store(cached_features_dir, ['unique_id', 'example_index', 'doc_span_index'])
+            examples, features = features_from_decoding_table(load_feature_extra(cached_features_dir, 'decoding'),
+                                                              *[column.tolist() for column in window_columns])
     else:
         logger.info("Creating features from dataset file at %s", input_file)
         examples = read_baidu_examples(input_file=input_file, is_training=not evaluate)
@@ -291,33 +336,47 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
                                                 max_seq_length=args.max_seq_length,
                                                 doc_stride=args.doc_stride,
                                                 max_query_length=args.max_query_length,
-                                                is_training=not evaluate)
+                                                is_training=not evaluate,
+                                                num_workers=getattr(args, 'preprocess_workers', 1))
 
         if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
+            logger.info("Saving features into cached file %s", cached_features_dir)
+            extras = {'decoding': decoding_table(examples, features)} if evaluate else None
+            write_feature_store(cached_features_dir, features, columns, args.max_seq_length, extras=extras)
 
     if args.local_rank == 0 and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    if evaluate:
-        all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
-        dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
+    # Build the dataset over the mapped columns (int16 / uint8, cast to long per batch in train / evaluate)
+    names = ['input_ids', 'input_mask', 'segment_ids']
+    if not evaluate:
+        names += ['start_position', 'end_position']
+    if has_feature_store(cached_features_dir):
+        tensors = load_feature_store(cached_features_dir, names)
     else:
-        all_start_positions = torch.tensor([f.start_position for f in features], dtype=torch.long)
-        all_end_positions = torch.tensor([f.end_position for f in features], dtype=torch.long)
-        dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                all_start_positions, all_end_positions)
-        
+        tensors = feature_tensors(features, columns, args.max_seq_length, names)
+    if evaluate:
+        tensors.append(torch.arange(tensors[0].size(0), dtype=torch.long))
+    dataset = TensorDataset(*tensors)
+
     if output_examples:
         return dataset, examples, features
     return dataset
 
 
+def load_stream(args, tokenizer):
+    """Streaming training set, --train_file may then be a glob pattern over JSONL shards."""
+    return JsonlStream(list_shards(args.train_file), stream_features,
+                       shuffle_buffer_size=args.shuffle_buffer_size,
+                       seed=args.seed,
+                       rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+                       world_size=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+                       tokenizer=fast_tokenizer(tokenizer),
+                       max_seq_length=args.max_seq_length,
+                       doc_stride=args.doc_stride,
+                       max_query_length=args.max_query_length)
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -353,7 +412,7 @@ def main():
     parser.add_argument("--do_eval", action='store_true',
                         help="Whether to run eval on the dev set.")
     parser.add_argument("--evaluate_during_training", action='store_true',
-                        help="Rul evaluation during training at each logging step.")
+                        help="Evaluate the step checkpoints (see --save_steps) in a background process during training.")
     parser.add_argument("--do_lower_case", action='store_true',
                         help="Set this flag if you are using an uncased model.")
 
@@ -390,6 +449,11 @@ def main():
                         help="Log every X updates steps.")
     parser.add_argument('--save_steps', type=int, default=50,
                         help="Save checkpoint every X updates steps.")
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help="Keep only the last X step checkpoints, 0 (default) keeps them all, "
+                             "as --eval_all_checkpoints needs")
+    parser.add_argument('--resume_from', default=None, type=str,
+                        help="Step checkpoint to resume training from, 'latest' for the last one in output_dir")
     parser.add_argument("--eval_all_checkpoints", action='store_true',
                         help="Evaluate all checkpoints starting with the same prefix as model_name ending and ending with step number")
     parser.add_argument("--no_cuda", action='store_true',
@@ -398,6 +462,14 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help="Number of processes converting examples to features (DataLoader workers with --streaming)")
+    parser.add_argument('--bucket_size', type=int, default=100,
+                        help="Training batches per length bucket (batches hold windows of similar length), 0 samples at random")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Stream the training set from JSONL shards instead of caching its features, needs --max_steps")
+    parser.add_argument('--shuffle_buffer_size', type=int, default=10000,
+                        help="Training items held in the shuffle buffer of each streaming reader")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
 
@@ -410,7 +482,7 @@ def main():
                              "See details at https://nvidia.github.io/apex/amp.html")
     args = parser.parse_args()
 
-    if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and args.do_train and not args.overwrite_output_dir:
+    if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and args.do_train and not args.overwrite_output_dir and not args.resume_from:
         raise ValueError("Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(args.output_dir))
 
     # Setup CUDA, GPU & distributed training
@@ -453,7 +525,10 @@ def main():
 
     # Training
     if args.do_train:
-        train_dataset = load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=False)
+        if args.streaming:
+            train_dataset = load_stream(args, tokenizer)
+        else:
+            train_dataset = load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=False)
         global_step, tr_loss = train(args, train_dataset, model, tokenizer)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
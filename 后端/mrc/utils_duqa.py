@@ -4,13 +4,21 @@
 from __future__ import absolute_import, division, print_function
 
 import collections
+import hashlib
 import json
 import logging
 import math
+import unicodedata
 from io import open
+
+import numpy as np
+import torch
 from tqdm import tqdm
 
-from transformers.tokenization_bert import BasicTokenizer, whitespace_tokenize
+from transformers.tokenization_bert import _is_control, _is_whitespace
+
+from utils.parallel import map_chunks
+from utils.tokenization import FastWordPiece, basic_tokenize, fast_tokenizer
 
 logger = logging.getLogger(__name__)
 
@@ -27,13 +35,16 @@ class BaiduExample(object):
                  doc_tokens,
                  orig_answer_text=None,
                  start_position=None,
-                 end_position=None,):
+                 end_position=None,
+                 doc_features=None):
         self.qas_id = qas_id
         self.question_text = question_text
         self.doc_tokens = doc_tokens
         self.orig_answer_text = orig_answer_text
         self.start_position = start_position
         self.end_position = end_position
+        # optional precomputed DocFeatures of doc_tokens (e.g. from the doc store)
+        self.doc_features = doc_features
 
     def __str__(self):
         return self.__repr__()
@@ -58,69 +69,137 @@ class InputFeatures(object):
                  example_index,
                  doc_span_index,
                  tokens,
-                 token_to_orig_map,
+                 token_to_orig_index,
                  token_is_max_context,
                  input_ids,
                  input_mask,
                  segment_ids,
                  start_position=None,
-                 end_position=None):
+                 end_position=None,
+                 doc_offset=None,
+                 doc_span_start=None):
         self.unique_id = unique_id
         self.example_index = example_index
         self.doc_span_index = doc_span_index
         self.tokens = tokens
-        self.token_to_orig_map = token_to_orig_map
+        # numpy arrays over the doc tokens of the window: jieba token index, max context flag
+        self.token_to_orig_index = token_to_orig_index
         self.token_is_max_context = token_is_max_context
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
         self.start_position = start_position
         self.end_position = end_position
+        # window position `doc_offset` holds the doc sub-token `doc_span_start`
+        self.doc_offset = doc_offset
+        self.doc_span_start = doc_span_start
+
+
+def feature_columns(tokenizer):
+    """(attribute, dtype) of the cached `InputFeatures` columns, see utils.feature_store."""
+    from utils.feature_store import ids_dtype  # training only, keep it out of the server import path
+    return [('input_ids', ids_dtype(len(tokenizer))),
+            ('input_mask', np.uint8),
+            ('segment_ids', np.uint8),
+            ('start_position', np.int16),
+            ('end_position', np.int16),
+            # per window side table
+            ('unique_id', np.int64),
+            ('example_index', np.int32),
+            ('doc_span_index', np.int32)]
+
+
+def decoding_table(examples, features):
+    """
+    What write_predictions needs of the features beside the per window columns of
+    `feature_columns` (unique_id, example_index, doc_span_index): the examples and
+    the doc part of every window. Cached with the dev set features.
+    """
+    windows = [(feature.tokens, feature.doc_offset, feature.doc_span_start,
+                feature.token_to_orig_index, feature.token_is_max_context) for feature in features]
+    return {'examples': examples, 'windows': windows}
+
+
+def features_from_decoding_table(table, unique_ids, example_indexes, doc_span_indexes):
+    """The (examples, features) of a `decoding_table`, the features without their input ids / masks."""
+    if not len(unique_ids) == len(example_indexes) == len(doc_span_indexes) == len(table['windows']):
+        raise ValueError("The decoding table does not match the cached features, delete the cache to rebuild it")
+    features = []
+    for (unique_id, example_index, doc_span_index, window) in zip(unique_ids, example_indexes, doc_span_indexes,
+                                                                  table['windows']):
+        tokens, doc_offset, doc_span_start, token_to_orig_index, token_is_max_context = window
+        features.append(InputFeatures(unique_id=unique_id,
+                                      example_index=example_index,
+                                      doc_span_index=doc_span_index,
+                                      tokens=tokens,
+                                      token_to_orig_index=token_to_orig_index,
+                                      token_is_max_context=token_is_max_context,
+                                      input_ids=None,
+                                      input_mask=None,
+                                      segment_ids=None,
+                                      doc_offset=doc_offset,
+                                      doc_span_start=doc_span_start))
+    return table['examples'], features
+
+
+def _baidu_example(example, is_training):
+    """One json line as a BaiduExample, None when the fake answer is not in the document."""
+    qas_id = example['question_id']
+    question_text = example['question']
+    context_tokens = example['doc_tokens']
+    start_position = None
+    end_position = None
+    orig_answer_text = None
+    #若不是训练，那么数据应该只包含问题，文本，以上三个信息都为None
+    #若是训练的话，
+    if is_training:
+        orig_answer_text = example['fake_answer'][0]
+        start_position = int(example['answer_span'][0])
+        end_position = int(example['answer_span'][1])
+
+        # 检测一下给出的fake answer 能否在文中找出来。 找不出来就跳过。
+        actual_text = "".join(context_tokens[start_position:(end_position+1)])
+        cleaned_answer_text = orig_answer_text
+        if actual_text.find(cleaned_answer_text) == -1:
+            return None
+    return BaiduExample(
+        qas_id=qas_id,
+        question_text=question_text,
+        doc_tokens=context_tokens,
+        orig_answer_text=orig_answer_text,
+        start_position=start_position,
+        end_position=end_position,
+        )
 
 
 def read_baidu_examples(input_file, is_training):
     """Read a baidu json file into a list of BaiduExample."""
-    def is_whitespace(c):
-        if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
-            return True
-        return False
     flag = 0
     with open(input_file, "r", encoding='utf-8') as reader:
         examples = []
         for line in tqdm(reader, desc='reading baidu examples...'):
-            example = json.loads(line)
-            qas_id = example['question_id']
-            question_text = example['question']
-            context_tokens = example['doc_tokens']
-            start_position = None
-            end_position = None
-            orig_answer_text = None
-            #若不是训练，那么数据应该只包含问题，文本，以上三个信息都为None
-            #若是训练的话，
-            if is_training:
-                orig_answer_text = example['fake_answer'][0]
-                start_position = int(example['answer_span'][0])
-                end_position = int(example['answer_span'][1])
-
-                # 检测一下给出的fake answer 能否在文中找出来。 找不出来就跳过。
-                actual_text = "".join(context_tokens[start_position:(end_position+1)])
-                cleaned_answer_text = orig_answer_text
-                if actual_text.find(cleaned_answer_text) == -1:
-                    flag += 1
-                    continue
-            per_example = BaiduExample(
-                qas_id=qas_id,
-                question_text=question_text,
-                doc_tokens=context_tokens,
-                orig_answer_text=orig_answer_text,
-                start_position=start_position,
-                end_position=end_position,
-                )
+            per_example = _baidu_example(json.loads(line), is_training)
+            if per_example is None:
+                flag += 1
+                continue
             examples.append(per_example)
     logger.warning("Could not find answer {}".format(flag))
     return examples
 
 
+def stream_features(example, tokenizer, max_seq_length, doc_stride, max_query_length):
+    """
+    The training windows of one json line, as (input_ids, input_mask, segment_ids,
+    start_position, end_position) tuples: the build_fn of a `utils.streaming.JsonlStream`.
+    """
+    per_example = _baidu_example(example, is_training=True)
+    if per_example is None:
+        return []
+    [(features, _)] = _convert_examples_chunk([per_example], 0, tokenizer, max_seq_length,
+                                              doc_stride, max_query_length, is_training=True)
+    return [(f.input_ids, f.input_mask, f.segment_ids, f.start_position, f.end_position) for f in features]
+
+
 def read_baidu_examples_pred(raw_data, is_training):
     """直接从[dir, dir...]读取数据"""
 
@@ -160,33 +239,202 @@ def read_baidu_examples_pred(raw_data, is_training):
             orig_answer_text=orig_answer_text,
             start_position=start_position,
             end_position=end_position,
+            doc_features=example.get('doc_features'),
         )
         examples.append(per_example)
     return examples
 
 
+# The question independent part of the features: WordPiece sub-tokens of a
+# document, their ids, the alignment with the (jieba) doc_tokens and the
+# [start, end) character span of every sub-token in "".join(doc_tokens).
+DocFeatures = collections.namedtuple("DocFeatures",
+                                     ["all_doc_tokens", "doc_token_ids", "tok_to_orig_index", "orig_to_tok_index",
+                                      "tok_char_spans"])
+# DocFeatures pickled before tok_char_spans existed (doc store) still load
+DocFeatures.__new__.__defaults__ = (None,)
+
+
+def doc_features_key(doc_tokens):
+    """Content hash of a tokenized document, the key of a doc features cache."""
+    return hashlib.sha1("\x00".join(doc_tokens).encode('utf-8')).hexdigest()
+
+
+def _normalize_chars(text, do_lower_case):
+    """
+    The text as BasicTokenizer sees it (control chars dropped, whitespace as " ",
+    lower cased, accents stripped) and, for every normalized char, the index of
+    the original char it comes from.
+    """
+    chars = []
+    char_index = []
+    for (i, c) in enumerate(text):
+        # same cleanup as BasicTokenizer._clean_text
+        if ord(c) == 0 or ord(c) == 0xfffd or _is_control(c):
+            continue
+        if _is_whitespace(c):
+            c = " "
+        if do_lower_case:
+            c = unicodedata.normalize("NFD", c.lower())
+            c = "".join(ch for ch in c if unicodedata.category(ch) != "Mn")
+        for ch in c:
+            chars.append(ch)
+            char_index.append(i)
+    return "".join(chars), char_index
+
+
+def _sub_token_char_spans(token, sub_tokens, do_lower_case, unk_token):
+    """
+    [start, end) char span in `token` of each of its WordPiece sub-tokens.
+    Sub-tokens that can't be found in the text ([UNK]) cover the gap up to the next one.
+    """
+    norm, char_index = _normalize_chars(token, do_lower_case)
+    spans = []
+    pending = []
+    cursor = 0
+    for sub_token in sub_tokens:
+        piece = sub_token[2:] if sub_token.startswith("##") else sub_token
+        pos = norm.find(piece, cursor) if piece and sub_token != unk_token else -1
+        if pos == -1:
+            pending.append(len(spans))
+            spans.append(None)
+            continue
+        for p in pending:
+            spans[p] = (cursor, pos)
+        pending = []
+        spans.append((pos, pos + len(piece)))
+        cursor = pos + len(piece)
+    for p in pending:
+        spans[p] = (cursor, len(norm))
+
+    char_spans = []
+    for (start, end) in spans:
+        while start < end and norm[start].isspace():
+            start += 1
+        while end > start and norm[end - 1].isspace():
+            end -= 1
+        if start == end:
+            orig = char_index[start] if start < len(char_index) else len(token)
+            char_spans.append((orig, orig))
+        else:
+            char_spans.append((char_index[start], char_index[end - 1] + 1))
+    return char_spans
+
+
+def tokenize_doc(doc_tokens, tokenizer):
+    """Build the `DocFeatures` of a document."""
+    # jieba tokens repeat a lot across documents: memoized per token, ids included
+    tokenizer = fast_tokenizer(tokenizer)
+    basic_tokenizer = getattr(tokenizer, 'basic_tokenizer', None)
+    do_lower_case = basic_tokenizer.do_lower_case if basic_tokenizer is not None else False
+    tok_to_orig_index = []
+    orig_to_tok_index = []
+    all_doc_tokens = []
+    tok_char_spans = []
+    doc_token_ids = []
+    char_offset = 0
+    for (i, token) in enumerate(doc_tokens):
+        orig_to_tok_index.append(len(all_doc_tokens))
+        if isinstance(tokenizer, FastWordPiece):
+            sub_tokens, sub_token_ids = tokenizer.tokenize_with_ids(token)
+        else:
+            sub_tokens = tokenizer.tokenize(token)
+            sub_token_ids = tokenizer.convert_tokens_to_ids(sub_tokens)
+        for (start, end) in _sub_token_char_spans(token, sub_tokens, do_lower_case, tokenizer.unk_token):
+            tok_char_spans.append((char_offset + start, char_offset + end))
+        for sub_token in sub_tokens:
+            tok_to_orig_index.append(i)
+            all_doc_tokens.append(sub_token)
+        doc_token_ids.extend(sub_token_ids)
+        char_offset += len(token)
+    return DocFeatures(all_doc_tokens=all_doc_tokens,
+                       doc_token_ids=doc_token_ids,
+                       tok_to_orig_index=tok_to_orig_index,
+                       orig_to_tok_index=orig_to_tok_index,
+                       tok_char_spans=tok_char_spans)
+
+
+def get_doc_features(doc_tokens, tokenizer, doc_cache=None):
+    """
+    `tokenize_doc` through `doc_cache` (an `utils.cache.LRUCache`, or None),
+    so the same document is only tokenized once whatever the question.
+    The cache must only ever be used with one tokenizer.
+    """
+    if doc_cache is None:
+        return tokenize_doc(doc_tokens, tokenizer)
+    key = doc_features_key(doc_tokens)
+    doc_features = doc_cache.get(key)
+    if doc_features is None:
+        doc_features = tokenize_doc(doc_tokens, tokenizer)
+        doc_cache.set(key, doc_features)
+    return doc_features
+
+
 def convert_examples_to_features(examples, tokenizer, max_seq_length,
-                                 doc_stride, max_query_length, is_training):
-    """Loads a data file into a list of `InputBatch`s."""
+                                 doc_stride, max_query_length, is_training,
+                                 doc_cache=None, pad_to_max_length=True, num_workers=1):
+    """
+    Loads a data file into a list of `InputBatch`s.
+    With pad_to_max_length=False the windows keep their real length and are
+    padded per batch instead (see utils.batching.pad_sequences).
+    With num_workers > 1 the examples are converted in ordered chunks on a
+    process pool (doc_cache is then not used); unique_ids are assigned afterwards
+    so they are the same whatever the number of workers.
+    """
+    tokenizer = fast_tokenizer(tokenizer)
+    results = map_chunks(_convert_examples_chunk, examples,
+                         num_workers=num_workers,
+                         desc='converting features...',
+                         tokenizer=tokenizer,
+                         max_seq_length=max_seq_length,
+                         doc_stride=doc_stride,
+                         max_query_length=max_query_length,
+                         is_training=is_training,
+                         doc_cache=doc_cache if num_workers <= 1 else None,
+                         pad_to_max_length=pad_to_max_length)
 
     unique_id = 1000000000
-
     features = []
-    for (example_index, example) in tqdm(enumerate(examples), desc='converting features...'):
+    for (example, (example_features, doc_features)) in zip(examples, results):
+        if doc_features is not None:
+            # kept for decoding: answers are sliced with doc_features.tok_char_spans
+            example.doc_features = doc_features
+        for feature in example_features:
+            feature.unique_id = unique_id
+            unique_id += 1
+            features.append(feature)
+    return features
+
+
+def _convert_examples_chunk(examples, example_index_offset, tokenizer, max_seq_length,
+                            doc_stride, max_query_length, is_training,
+                            doc_cache=None, pad_to_max_length=True):
+    """
+    Features of a chunk of examples, as one (features, doc_features) pair per
+    example; doc_features is only returned when it was computed here for prediction.
+    """
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+
+    results = []
+    for (i, example) in enumerate(examples):
+        example_index = example_index_offset + i
+        features = []
         query_tokens = tokenizer.tokenize(example.question_text)
 
         if len(query_tokens) > max_query_length:
             query_tokens = query_tokens[0:max_query_length]
-
-        tok_to_orig_index = []
-        orig_to_tok_index = []
-        all_doc_tokens = []
-        for (i, token) in enumerate(example.doc_tokens):
-            orig_to_tok_index.append(len(all_doc_tokens))
-            sub_tokens = tokenizer.tokenize(token)
-            for sub_token in sub_tokens:
-                tok_to_orig_index.append(i)
-                all_doc_tokens.append(sub_token)
+        query_ids = tokenizer.convert_tokens_to_ids(query_tokens)
+
+        doc_features = example.doc_features
+        computed_doc_features = None
+        if doc_features is None:
+            doc_features = get_doc_features(example.doc_tokens, tokenizer, doc_cache)
+            if not is_training:
+                computed_doc_features = doc_features
+        all_doc_tokens = doc_features.all_doc_tokens
+        doc_token_ids = doc_features.doc_token_ids
+        tok_to_orig_index = doc_features.tok_to_orig_index
+        orig_to_tok_index = doc_features.orig_to_tok_index
 
         tok_start_position = None
         tok_end_position = None
@@ -219,79 +467,74 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
                 break
             start_offset += min(length, doc_stride)
 
+        # the max context span of every doc sub-token, one pass over the spans
+        max_context_span = _max_context_span_indexes(doc_spans, len(all_doc_tokens))
+        tok_to_orig_array = np.asarray(tok_to_orig_index, dtype=np.int32)
+
         for (doc_span_index, doc_span) in enumerate(doc_spans):
-            tokens = []
-            token_to_orig_map = {}
-            token_is_max_context = {}
-            segment_ids = []
-            tokens.append("[CLS]")
-            segment_ids.append(0)
-            for token in query_tokens:
-                tokens.append(token)
-                segment_ids.append(0)
-            tokens.append("[SEP]")
-            segment_ids.append(0)
-
-            for i in range(doc_span.length):
-                split_token_index = doc_span.start + i
-                token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
-
-                is_max_context = _check_is_max_context(doc_spans, doc_span_index,
-                                                       split_token_index)
-                token_is_max_context[len(tokens)] = is_max_context
-                tokens.append(all_doc_tokens[split_token_index])
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
+            doc_start = doc_span.start
+            doc_end = doc_span.start + doc_span.length - 1
+            if is_training:
+                # For training, if our document chunk does not contain an annotation
+                # we throw it out, since there is nothing to predict.
+                # Checked before the window is built, most windows of a long page are skipped.
+                if (example.start_position < doc_start or
+                        example.end_position < doc_start or
+                        example.start_position > doc_end or example.end_position > doc_end):
+                    continue
+
+            span_end = doc_span.start + doc_span.length
+            tokens = (["[CLS]"] + query_tokens + ["[SEP]"] +
+                      all_doc_tokens[doc_span.start:span_end] + ["[SEP]"])
+            segment_ids = [0] * (len(query_tokens) + 2) + [1] * (doc_span.length + 1)
+            # per doc token of the window (window position doc_offset + i)
+            token_to_orig_index = tok_to_orig_array[doc_span.start:span_end]
+            token_is_max_context = max_context_span[doc_span.start:span_end] == doc_span_index
+
+            input_ids = ([cls_id] + query_ids + [sep_id] +
+                         doc_token_ids[doc_span.start:doc_span.start + doc_span.length] + [sep_id])
 
             # The mask has 1 for real tokens and 0 for padding tokens. Only real
             # tokens are attended to.
             input_mask = [1] * len(input_ids)
 
             # Zero-pad up to the sequence length.
-            while len(input_ids) < max_seq_length:
-                input_ids.append(0)
-                input_mask.append(0)
-                segment_ids.append(0)
+            if pad_to_max_length:
+                while len(input_ids) < max_seq_length:
+                    input_ids.append(0)
+                    input_mask.append(0)
+                    segment_ids.append(0)
 
-            assert len(input_ids) == max_seq_length
-            assert len(input_mask) == max_seq_length
-            assert len(segment_ids) == max_seq_length
+                assert len(input_ids) == max_seq_length
+            assert len(input_ids) <= max_seq_length
+            assert len(input_mask) == len(input_ids)
+            assert len(segment_ids) == len(input_ids)
 
             start_position = None
             end_position = None
             if is_training:
-                # For training, if our document chunk does not contain an annotation
-                # we throw it out, since there is nothing to predict.
-                doc_start = doc_span.start
-                doc_end = doc_span.start + doc_span.length - 1
-                if (example.start_position < doc_start or
-                        example.end_position < doc_start or
-                        example.start_position > doc_end or example.end_position > doc_end):
-                    continue
-
                 doc_offset = len(query_tokens) + 2
                 start_position = tok_start_position - doc_start + doc_offset
                 end_position = tok_end_position - doc_start + doc_offset
 
             features.append(
                 InputFeatures(
-                    unique_id=unique_id,
+                    unique_id=None,  # set by convert_examples_to_features
                     example_index=example_index,
                     doc_span_index=doc_span_index,
                     tokens=tokens,
-                    token_to_orig_map=token_to_orig_map,
+                    token_to_orig_index=token_to_orig_index,
                     token_is_max_context=token_is_max_context,
                     input_ids=input_ids,
                     input_mask=input_mask,
                     segment_ids=segment_ids,
                     start_position=start_position,
-                    end_position=end_position))
-            unique_id += 1
+                    end_position=end_position,
+                    doc_offset=len(query_tokens) + 2,
+                    doc_span_start=doc_span.start))
 
-    return features
+        results.append((features, computed_doc_features))
+    return results
 
 
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
@@ -308,8 +551,8 @@ def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
     return (input_start, input_end)
 
 
-def _check_is_max_context(doc_spans, cur_span_index, position):
-    """Check if this is the 'max context' doc span for the token."""
+def _max_context_span_indexes(doc_spans, num_tokens):
+    """For every doc sub-token, the index of its 'max context' doc span."""
 
     # Because of the sliding window approach taken to scoring documents, a single
     # token can appear in multiple documents. E.g.
@@ -327,28 +570,185 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
     # In the example the maximum context for 'bought' would be span C since
     # it has 1 left context and 3 right context, while span B has 4 left context
     # and 0 right context.
-    best_score = None
-    best_span_index = None
+    #
+    # Each span only updates the tokens it covers, so this is linear in the
+    # total window length; ties keep the earlier span.
+    best_score = np.full(num_tokens, -1.0)
+    best_span_index = np.full(num_tokens, -1, dtype=np.int32)
     for (span_index, doc_span) in enumerate(doc_spans):
         end = doc_span.start + doc_span.length - 1
-        if position < doc_span.start:
-            continue
-        if position > end:
-            continue
-        num_left_context = position - doc_span.start
-        num_right_context = end - position
-        score = min(num_left_context, num_right_context) + 0.01 * doc_span.length
-        if best_score is None or score > best_score:
-            best_score = score
-            best_span_index = span_index
-
-    return cur_span_index == best_span_index
+        positions = np.arange(doc_span.start, end + 1)
+        score = np.minimum(positions - doc_span.start, end - positions) + 0.01 * doc_span.length
+        better = score > best_score[doc_span.start:end + 1]
+        best_score[doc_span.start:end + 1][better] = score[better]
+        best_span_index[doc_span.start:end + 1][better] = span_index
+    return best_span_index
 
 
 RawResult = collections.namedtuple("RawResult",
                                    ["unique_id", "start_logits", "end_logits"])
 
 
+def _window_doc_arrays(feature):
+    """
+    (doc_offset, token_to_orig_index, token_is_max_context) of a window, also
+    for features cached before the arrays replaced the position -> value dicts.
+    """
+    if hasattr(feature, 'token_to_orig_map'):
+        doc_positions = list(feature.token_to_orig_map)
+        return (doc_positions[0],
+                np.asarray(list(feature.token_to_orig_map.values()), dtype=np.int32),
+                np.asarray(list(feature.token_is_max_context.values()), dtype=bool))
+    return feature.doc_offset, feature.token_to_orig_index, feature.token_is_max_context
+
+
+def _span_candidates(feature, result, n_best_size, max_answer_length):
+    """
+    Valid (start, end) pairs among the n_best start and n_best end logits of one window.
+
+    Same filter as the former start x end double loop, run as one [k, k] mask:
+    both ends inside the document, start in its max context, end >= start and
+    span length <= max_answer_length. Pairs come out in the loop order (start-major).
+    """
+    start_logits = torch.as_tensor(result.start_logits, dtype=torch.float64)
+    end_logits = torch.as_tensor(result.end_logits, dtype=torch.float64)
+    num_positions = start_logits.size(0)
+    k = min(n_best_size, num_positions)
+    start_indexes = start_logits.topk(k)[1]
+    end_indexes = end_logits.topk(k)[1]
+
+    doc_offset, token_to_orig_index, token_is_max_context = _window_doc_arrays(feature)
+    doc_end = doc_offset + len(token_to_orig_index)
+    in_doc = torch.zeros(num_positions, dtype=torch.bool)
+    max_context = torch.zeros(num_positions, dtype=torch.bool)
+    in_doc[doc_offset:doc_end] = True
+    max_context[doc_offset:doc_end] = torch.from_numpy(token_is_max_context.astype(np.uint8)).bool()
+
+    span = end_indexes.unsqueeze(0) - start_indexes.unsqueeze(1)
+    keep = ((in_doc & max_context)[start_indexes].unsqueeze(1) &
+            in_doc[end_indexes].unsqueeze(0) &
+            (span >= 0) & (span < max_answer_length))
+    pairs = keep.nonzero()
+    return start_indexes[pairs[:, 0]], end_indexes[pairs[:, 1]], start_logits, end_logits
+
+
+def _span_text(example, doc_text, feature, start_index, end_index, do_lower_case, verbose_logging):
+    """
+    Answer text of window positions [start_index, end_index] and its [start, end)
+    char offsets in doc_text ("".join(example.doc_tokens)).
+    Features built before char spans were recorded fall back to get_final_text, without offsets.
+    """
+    doc_features = example.doc_features
+    doc_span_start = getattr(feature, 'doc_span_start', None)
+    if doc_features is not None and doc_features.tok_char_spans is not None and doc_span_start is not None:
+        start_char = doc_features.tok_char_spans[doc_span_start + start_index - feature.doc_offset][0]
+        end_char = doc_features.tok_char_spans[doc_span_start + end_index - feature.doc_offset][1]
+        return doc_text[start_char:end_char], start_char, end_char
+
+    doc_offset, token_to_orig_index, _ = _window_doc_arrays(feature)
+    tok_tokens = feature.tokens[start_index:(end_index + 1)]
+    orig_doc_start = int(token_to_orig_index[start_index - doc_offset])
+    orig_doc_end = int(token_to_orig_index[end_index - doc_offset])
+    orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
+    tok_text = " ".join(tok_tokens)
+
+    # De-tokenize WordPieces that have been split off.
+    tok_text = tok_text.replace(" ##", "")
+    tok_text = tok_text.replace("##", "")
+
+    # Clean whitespace
+    tok_text = tok_text.strip()
+    tok_text = " ".join(tok_text.split())
+    orig_text = " ".join(orig_tokens)
+
+    return get_final_text(tok_text, orig_text, do_lower_case, verbose_logging), None, None
+
+
+def _nbest_predictions(example, features, unique_id_to_result, n_best_size,
+                       max_answer_length, do_lower_case, verbose_logging):
+    """
+    n-best answers of one example over all its windows, best first.
+    Scores and probabilities are computed on tensors, only the rows that are
+    turned into text are moved to Python, n_best_size rows at a time.
+    """
+    doc_text = "".join(example.doc_tokens)
+    columns = []
+    for (feature_index, feature) in enumerate(features):
+        result = unique_id_to_result[feature.unique_id]
+        start_indexes, end_indexes, start_logits, end_logits = _span_candidates(
+            feature, result, n_best_size, max_answer_length)
+        if start_indexes.numel() == 0:
+            continue
+        start_logit = start_logits[start_indexes]
+        end_logit = end_logits[end_indexes]
+        columns.append(torch.stack([
+            torch.full_like(start_logit, feature_index),
+            start_indexes.double(),
+            end_indexes.double(),
+            start_logit,
+            end_logit,
+            # softmax over (start, end) logits of the start / end token
+            torch.sigmoid(start_logit - end_logits[start_indexes]),
+            torch.sigmoid(end_logit - start_logits[end_indexes]),
+            torch.sigmoid(start_logit),
+            torch.sigmoid(end_logit)], dim=1))
+
+    seen_predictions = {}
+    nbest = []
+    if columns:
+        candidates = torch.cat(columns, dim=0)
+        # stable: equal scores keep the window / start / end order, as the former sorted() did
+        order = torch.from_numpy(np.argsort(-(candidates[:, 3] + candidates[:, 4]).numpy(), kind='stable'))
+        candidates = candidates[order]
+        for chunk_start in range(0, candidates.size(0), n_best_size):
+            for row in candidates[chunk_start:chunk_start + n_best_size].tolist():
+                if len(nbest) >= n_best_size:
+                    break
+                feature = features[int(row[0])]
+                final_text, start_char, end_char = _span_text(example, doc_text, feature, int(row[1]), int(row[2]),
+                                                              do_lower_case, verbose_logging)
+                if final_text in seen_predictions:
+                    continue
+
+                seen_predictions[final_text] = True
+                output = collections.OrderedDict()
+                output["text"] = final_text
+                output["start_char"] = start_char
+                output["end_char"] = end_char
+                output["start_logit"] = row[3]
+                output["end_logit"] = row[4]
+                output["start_prob"] = row[5]
+                output["start_prob_v1"] = row[7]
+                output["end_prob"] = row[6]
+                output["end_prob_v1"] = row[8]
+                nbest.append(output)
+            if len(nbest) >= n_best_size:
+                break
+
+    # In very rare edge cases we could have no valid predictions. So we
+    # just create a nonce prediction in this case to avoid failure.
+    if not nbest:
+        output = collections.OrderedDict()
+        output["text"] = "empty"
+        output["start_char"] = None
+        output["end_char"] = None
+        for key in ["start_logit", "end_logit", "start_prob", "start_prob_v1", "end_prob", "end_prob_v1"]:
+            output[key] = 0.0
+        nbest.append(output)
+
+    probs = _compute_softmax([entry["start_logit"] + entry["end_logit"] for entry in nbest])
+    nbest_json = []
+    for (i, entry) in enumerate(nbest):
+        output = collections.OrderedDict()
+        output["text"] = entry["text"]
+        output["probability"] = probs[i]
+        for key in ["start_logit", "end_logit", "start_prob", "start_prob_v1", "end_prob", "end_prob_v1",
+                    "start_char", "end_char"]:
+            output[key] = entry[key]
+        nbest_json.append(output)
+    return nbest_json
+
+
 def write_predictions(all_examples, all_features, all_results, n_best_size,
                       max_answer_length, do_lower_case, output_prediction_file,
                       output_nbest_file, verbose_logging):
@@ -364,115 +764,16 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
     for result in all_results:
         unique_id_to_result[result.unique_id] = result
 
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction",
-        ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
-
     all_predictions = collections.OrderedDict()
     all_nbest_json = collections.OrderedDict()
     for (example_index, example) in enumerate(all_examples):
         features = example_index_to_features[example_index]
-
-        prelim_predictions = []
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index]))
-
-        prelim_predictions = sorted(
-            prelim_predictions,
-            key=lambda x: (x.start_logit + x.end_logit),
-            reverse=True)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit"])
-
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            feature = features[pred.feature_index]
-
-            tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
-            orig_doc_start = feature.token_to_orig_map[pred.start_index]
-            orig_doc_end = feature.token_to_orig_map[pred.end_index]
-            orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-            tok_text = " ".join(tok_tokens)
-
-            # De-tokenize WordPieces that have been split off.
-            tok_text = tok_text.replace(" ##", "")
-            tok_text = tok_text.replace("##", "")
-
-            # Clean whitespace
-            tok_text = tok_text.strip()
-            tok_text = " ".join(tok_text.split())
-            orig_text = " ".join(orig_tokens)
-
-            final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
-            if final_text in seen_predictions:
-                continue
-
-            seen_predictions[final_text] = True
-            nbest.append(
-                _NbestPrediction(
-                    text=final_text,
-                    start_logit=pred.start_logit,
-                    end_logit=pred.end_logit))
-
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(
-                _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-
-        assert len(nbest) >= 1
-
-        total_scores = []
-        for entry in nbest:
-            total_scores.append(entry.start_logit + entry.end_logit)
-
-        probs = _compute_softmax(total_scores)
-
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            nbest_json.append(output)
-
-        assert len(nbest_json) >= 1
-        i = 0
+        nbest_json = _nbest_predictions(example, features, unique_id_to_result, n_best_size,
+                                        max_answer_length, do_lower_case, verbose_logging)
+        # the prediction files keep their original fields
+        nbest_json = [collections.OrderedDict((key, entry[key]) for key in
+                                              ["text", "probability", "start_logit", "end_logit"])
+                      for entry in nbest_json]
 
         all_predictions[example.qas_id] = nbest_json[0]["text"]
         all_nbest_json[example.qas_id] = nbest_json
@@ -482,11 +783,12 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
 
     with open(output_nbest_file, "w") as writer:
         writer.write(json.dumps(all_nbest_json, indent=4,ensure_ascii=False) + "\n")
+    return all_predictions
 
 
 def convert_output(all_examples, all_features, all_results, n_best_size,
                     max_answer_length, do_lower_case, verbose_logging):
-    """TBD"""
+    """Same decoding as write_predictions, returned instead of written, with the start/end probabilities."""
     example_index_to_features = collections.defaultdict(list)
     for feature in all_features:
         example_index_to_features[feature.example_index].append(feature)
@@ -495,127 +797,12 @@ def convert_output(all_examples, all_features, all_results, n_best_size,
     for result in all_results:
         unique_id_to_result[result.unique_id] = result
 
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction",
-        ["feature_index", "start_index", "end_index", "start_logit", "end_logit", "start_prob", "end_prob", "start_prob_v1", "end_prob_v1"])
-
     all_predictions = collections.OrderedDict()
     all_nbest_json = collections.OrderedDict()
     for (example_index, example) in enumerate(all_examples):
         features = example_index_to_features[example_index]
-
-        prelim_predictions = []
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                            start_prob=_compute_softmax([result.start_logits[start_index], result.end_logits[start_index]])[0],
-                            start_prob_v1=_compute_sigmoid(result.start_logits[start_index]),
-                            end_prob=_compute_softmax([result.start_logits[end_index], result.end_logits[end_index]])[1],
-                            end_prob_v1=_compute_sigmoid(result.end_logits[end_index])))
-
-        prelim_predictions = sorted(
-            prelim_predictions,
-            key=lambda x: (x.start_logit + x.end_logit),
-            reverse=True)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit", "start_prob", "end_prob", "start_prob_v1", "end_prob_v1"])
-
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            feature = features[pred.feature_index]
-
-            tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
-            orig_doc_start = feature.token_to_orig_map[pred.start_index]
-            orig_doc_end = feature.token_to_orig_map[pred.end_index]
-            orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-            tok_text = " ".join(tok_tokens)
-
-            # De-tokenize WordPieces that have been split off.
-            tok_text = tok_text.replace(" ##", "")
-            tok_text = tok_text.replace("##", "")
-
-            # Clean whitespace
-            tok_text = tok_text.strip()
-            tok_text = " ".join(tok_text.split())
-            orig_text = " ".join(orig_tokens)
-
-            final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
-            if final_text in seen_predictions:
-                continue
-
-            seen_predictions[final_text] = True
-            nbest.append(
-                _NbestPrediction(
-                    text=final_text,
-                    start_logit=pred.start_logit,
-                    end_logit=pred.end_logit,
-                    start_prob=pred.start_prob,
-                    start_prob_v1=pred.start_prob_v1,
-                    end_prob=pred.end_prob,
-                    end_prob_v1=pred.end_prob_v1))
-
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(
-                _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0, start_prob=0.0, start_prob_v1=0.0, end_prob=0.0, end_prob_v1=0.0))
-
-        assert len(nbest) >= 1
-
-        total_scores = []
-        for entry in nbest:
-            total_scores.append(entry.start_logit + entry.end_logit)
-
-        probs = _compute_softmax(total_scores)
-
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            output["start_prob"] = entry.start_prob
-            output["start_prob_v1"] = entry.start_prob_v1
-            output["end_prob"] = entry.end_prob
-            output["end_prob_v1"] = entry.end_prob_v1
-            nbest_json.append(output)
-
-        assert len(nbest_json) >= 1
-        i = 0
+        nbest_json = _nbest_predictions(example, features, unique_id_to_result, n_best_size,
+                                        max_answer_length, do_lower_case, verbose_logging)
 
         all_predictions[example.qas_id] = nbest_json[0]["text"]
         all_nbest_json[example.qas_id] = nbest_json
@@ -666,9 +853,7 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
     # and `pred_text`, and check if they are the same length. If they are
     # NOT the same length, the heuristic has failed. If they are the same
     # length, we assume the characters are one-to-one aligned.
-    tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-
-    tok_text = " ".join(tokenizer.tokenize(orig_text))
+    tok_text = " ".join(basic_tokenize(orig_text, do_lower_case))
 
     start_position = tok_text.find(pred_text)
     if start_position == -1:
@@ -719,18 +904,6 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
     return output_text
 
 
-def _get_best_indexes(logits, n_best_size):
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
-
-
 def _compute_softmax(scores):
     """Compute softmax probability over raw logits."""
     if not scores:
@@ -752,6 +925,3 @@ def _compute_softmax(scores):
     for score in exp_scores:
         probs.append(score / total_sum)
     return probs
-
-def _compute_sigmoid(score):
-    return 1/(1 + math.exp(-score))
@@ -5,6 +5,11 @@
 # @Email : weiranbit@163.com
 # @File : __init__.py
 
-from .run_rerank import MODEL_CLASSES as rerank_MODEL_CLASSES
-from .run_rerank import predict as rerank_predict
-from .run_rerank import main as rerank_train
\ No newline at end of file
+from .predict_rerank import MODEL_CLASSES as rerank_MODEL_CLASSES
+from .predict_rerank import predict as rerank_predict
+
+
+# run_rerank pulls in the training-only modules, imported on first use (see mrc/__init__.py)
+def rerank_train():
+    from .run_rerank import main
+    return main()
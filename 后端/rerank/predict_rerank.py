@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+""" Scoring with a fine-tuned rerank model: what the server imports, without the training modules. """
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import logging
+import random
+
+import numpy as np
+import torch
+from transformers import BertConfig, BertForSequenceClassification, BertTokenizer
+
+from models.onnx_backend import OnnxModel
+from utils.batching import pad_sequences
+
+from .utils_rerank import convert_examples_to_features, processors
+
+logger = logging.getLogger(__name__)
+
+MODEL_CLASSES = {
+    'bert': (BertConfig, BertForSequenceClassification, BertTokenizer),
+    'bert_onnx': (BertConfig, OnnxModel, BertTokenizer)  # inference only, see export_onnx.py
+}
+
+def set_seed(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.n_gpu > 0:
+        torch.cuda.manual_seed_all(args.seed)
+
+
+def predict(args, model, tokenizer, examples, score_cache=None):
+    """
+    Score every (question, answer) pair and return {question_id: [logit_0, logit_1]}.
+
+    Identical pairs (the same answer extracted from several documents) are scored
+    once and fanned back out to their question_ids. Pairs found in score_cache
+    (an utils.cache.LRUCache keyed by (question, answer)) skip the model entirely.
+    """
+    # 去重: 同一 (question, answer) 只算一次
+    pair_to_qids = collections.OrderedDict()
+    for example in examples:
+        pair_to_qids.setdefault((example['question'], example['answer']), []).append(example['question_id'])
+
+    scores = {}
+    pending = []
+    for pair in pair_to_qids:
+        cached = score_cache.get(pair) if score_cache is not None else None
+        if cached is not None:
+            scores[pair] = cached
+        else:
+            pending.append(pair)
+
+    if pending:
+        predict_processors = processors['duqa']()
+        predict_examples = predict_processors.get_predict_examples(
+            [{'question': question, 'answer': answer} for question, answer in pending])
+        predict_features = convert_examples_to_features(
+            examples=predict_examples,
+            label_list=predict_processors.get_labels(),
+            max_seq_length=args.max_seq_length,
+            tokenizer=tokenizer,
+            pad_to_max_length=False
+        )
+
+        args.predict_batch_size = args.per_gpu_predict_batch_size * max(1, args.n_gpu)
+        # 按长度排序, 每个 batch 只 pad 到 batch 内最长的 pair
+        order = sorted(range(len(predict_features)), key=lambda i: len(predict_features[i].input_ids), reverse=True)
+
+        # Predict!
+        logger.info("***** Running prediction *****")
+        logger.info("  Num examples = %d, unique pairs = %d, to score = %d", len(examples), len(pair_to_qids), len(pending))
+        logger.info("  Batch size = %d", args.predict_batch_size)
+        model.eval()
+        for start in range(0, len(order), args.predict_batch_size):
+            indices = order[start:start + args.predict_batch_size]
+            batch = (pad_sequences([predict_features[i].input_ids for i in indices]),
+                     pad_sequences([predict_features[i].input_mask for i in indices]),
+                     pad_sequences([predict_features[i].segment_ids for i in indices]))
+            batch = tuple(t.to(args.device) for t in batch)
+            with torch.no_grad():
+                inputs = {'input_ids':      batch[0],
+                          'attention_mask': batch[1],
+                          'token_type_ids': batch[2]
+                          }
+                outputs = model(**inputs)
+                logits = outputs[0]
+
+            for j, i in enumerate(indices):
+                score = [round(logits[j][0].item(), 4), round(logits[j][1].item(), 4)]
+                scores[pending[i]] = score
+                if score_cache is not None:
+                    score_cache.set(pending[i], score)
+
+    result = {}
+    for pair, qids in pair_to_qids.items():
+        for qid in qids:
+            result[qid] = list(scores[pair])
+
+    return result
@@ -4,10 +4,11 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
+import copy
 import glob
+import itertools
 import logging
 import os
-import random
 import sys
 
 # ## 难顶啊。不会搞路径，只能暴力加
@@ -16,30 +17,29 @@ import sys
 
 import numpy as np
 import torch
-from tensorboardX import SummaryWriter
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+from torch.utils.data import (DataLoader, IterableDataset, RandomSampler,
+                              SequentialSampler, TensorDataset)
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
-from transformers import (WEIGHTS_NAME, AdamW, BertConfig,
-                          BertForSequenceClassification, BertTokenizer,
-                          WarmupLinearSchedule)
+from transformers import WEIGHTS_NAME, AdamW, WarmupLinearSchedule
 
-from .utils_rerank import convert_examples_to_features, processors
+from utils.batching import BucketBatchSampler, trim_batch
+from utils.checkpoint import (AsyncCheckpointWriter, find_checkpoint,
+                              load_training_state, set_rng_state,
+                              training_snapshot)
+from utils.eval_worker import EvalWorker
+from utils.feature_store import (feature_tensors, has_feature_store,
+                                 load_feature_store, store_dir,
+                                 write_feature_store)
+from utils.streaming import JsonlStream, list_shards
+from utils.tokenization import fast_tokenizer
 
+from .predict_rerank import MODEL_CLASSES, set_seed
+from .utils_rerank import (convert_examples_to_features, feature_columns,
+                           processors, stream_features)
 
-logger = logging.getLogger(__name__)
-
-MODEL_CLASSES = {
-    'bert': (BertConfig, BertForSequenceClassification, BertTokenizer)
-}
 
-def set_seed(args):
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    if args.n_gpu > 0:
-        torch.cuda.manual_seed_all(args.seed)
+logger = logging.getLogger(__name__)
 
 
 def simple_accuracy(preds, labels):
@@ -49,13 +49,34 @@ def simple_accuracy(preds, labels):
 def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     if args.local_rank in [-1, 0]:
+        from tensorboardX import SummaryWriter  # training only, keep it out of the server import path
         tb_writer = SummaryWriter()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    streaming = isinstance(train_dataset, IterableDataset)
+    train_sampler = None
+    if streaming:
+        # shuffled and sharded per rank / worker by the stream itself, the workers build the windows
+        train_dataloader = DataLoader(train_dataset, batch_size=args.train_batch_size,
+                                      num_workers=args.preprocess_workers)
+    elif args.bucket_size > 0:
+        # batches of windows of similar length, trimmed to their longest window in the loop
+        train_sampler = BucketBatchSampler(train_dataset.tensors[1].sum(dim=1), args.train_batch_size,
+                                           bucket_size=args.bucket_size, seed=args.seed)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler)
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
 
-    if args.max_steps > 0:
+    if streaming:
+        if args.max_steps <= 0:
+            raise ValueError("--streaming needs --max_steps, a stream has no length")
+        t_total = args.max_steps
+        # the stream never ends: every epoch takes the same number of batches on every rank
+        num_epochs = max(1, int(args.num_train_epochs))
+        batches_per_epoch = (t_total + num_epochs - 1) // num_epochs * args.gradient_accumulation_steps
+        train_batches = iter(train_dataloader)
+    elif args.max_steps > 0:
         t_total = args.max_steps
         args.num_train_epochs = args.max_steps // (len(train_dataloader) // args.gradient_accumulation_steps) + 1
     else:
@@ -69,6 +90,10 @@ def train(args, train_dataset, model, tokenizer):
         ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = WarmupLinearSchedule(optimizer, warmup_steps=args.warmup_steps, t_total=t_total)
+    resume_state = None
+    if args.resume_from:
+        resume_state = load_training_state(find_checkpoint(args.resume_from, args.output_dir, 'checkpoint-'),
+                                           model, optimizer, scheduler)
     if args.fp16:
         try:
             from apex import amp
@@ -88,7 +113,8 @@ def train(args, train_dataset, model, tokenizer):
 
     # Train!
     logger.info("***** Running training *****")
-    logger.info("  Num examples = %d", len(train_dataset))
+    if not streaming:
+        logger.info("  Num examples = %d", len(train_dataset))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
     logger.info("  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size)
     logger.info("  Total train batch size (w. parallel, distributed & accumulation) = %d",
@@ -98,16 +124,53 @@ def train(args, train_dataset, model, tokenizer):
 
     global_step = 0
     tr_loss, logging_loss = 0.0, 0.0
-    best_dev_acc, best_dev_loss = 0.0, 99999999999.0
-    best_steps = 0
+    start_epoch, skip_batches = 0, 0
+    if resume_state is not None:
+        global_step = resume_state['global_step']
+        tr_loss, logging_loss = resume_state['tr_loss'], resume_state['logging_loss']
+        # continue right after the last batch of the checkpoint
+        start_epoch, skip_batches = resume_state['epoch'], resume_state['step'] + 1
+        if streaming:
+            train_batches = itertools.islice(train_batches, start_epoch * batches_per_epoch, None)
+    checkpoint_writer, eval_worker = None, None
+    if args.local_rank in [-1, 0]:
+        # the eval worker below must see every step checkpoint before it is pruned
+        wait_for_eval = args.local_rank == -1 and args.evaluate_during_training
+        keep = args.keep_checkpoints
+        if keep and args.eval_all_checkpoints:
+            logger.warning("--eval_all_checkpoints evaluates every step checkpoint, --keep_checkpoints is ignored")
+            keep = 0
+        checkpoint_writer = AsyncCheckpointWriter(prefix='checkpoint-', keep=keep,
+                                                  wait_for_eval=wait_for_eval)
+    if args.local_rank == -1 and args.evaluate_during_training:  # Only evaluate when single GPU otherwise metrics may not average well
+        # the step checkpoints are evaluated in another process as they are written, training goes on
+        if args.save_steps <= 0:
+            raise ValueError("--evaluate_during_training evaluates the step checkpoints, set --save_steps")
+        eval_worker = EvalWorker(evaluate_checkpoint, args, tokenizer, tb_writer.logdir,
+                                 prefix='checkpoint-', start_step=global_step)
     model.zero_grad()
     train_iterator = trange(int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0])
     set_seed(args)  # Added here for reproductibility (even between python 2 and 3)
-    for _ in train_iterator:
-        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
+    for epoch_idx in train_iterator:
+        if epoch_idx < start_epoch:
+            continue
+        if hasattr(train_sampler, 'set_epoch'):
+            train_sampler.set_epoch(epoch_idx)  # reshuffle, the same way on every process
+        if resume_state is not None:
+            torch.set_rng_state(resume_state['epoch_rng_state'])  # RandomSampler: same order as the interrupted epoch
+        epoch_rng_state = torch.get_rng_state()
+        epoch_iterator = tqdm(itertools.islice(train_batches, batches_per_epoch) if streaming else train_dataloader,
+                              total=batches_per_epoch if streaming else None,
+                              desc="Iteration", disable=args.local_rank not in [-1, 0])
         for step, batch in enumerate(epoch_iterator):
+            if resume_state is not None:
+                if step < skip_batches:
+                    continue
+                set_rng_state(resume_state['rng'])
+                resume_state = None
             model.train()
-            batch = tuple(t.to(args.device) for t in batch)
+            batch = trim_batch(batch)
+            batch = tuple(t.to(args.device).long() for t in batch)
             inputs = {'input_ids':      batch[0],
                       'attention_mask': batch[1],
                       'token_type_ids': batch[2],  # XLM don't use segment_ids
@@ -138,53 +201,49 @@ def train(args, train_dataset, model, tokenizer):
 
                 if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
                     # Log metrics
-                    if args.local_rank == -1 and args.evaluate_during_training:  # Only evaluate when single GPU otherwise metrics may not average well
-                        results = evaluate(args, model, tokenizer)
-                        for key, value in results.items():
-                            tb_writer.add_scalar('eval_{}'.format(key), value, global_step)
-                        if results["eval_acc"] > best_dev_acc:
-                            best_dev_acc = results["eval_acc"]
-                            best_dev_loss = results["eval_loss"]
-                            best_steps = global_step
-                            if args.do_test:
-                                results_test = evaluate(args, model, tokenizer, test=True)
-                                for key, value in results_test.items():
-                                    tb_writer.add_scalar('test_{}'.format(key), value, global_step)
-                                logger.info("test acc: %s, loss: %s, global steps: %s", str(results_test['eval_acc']), str(results_test['eval_loss']), str(global_step))
                     tb_writer.add_scalar('lr', scheduler.get_lr()[0], global_step)
                     tb_writer.add_scalar('loss', (tr_loss - logging_loss)/args.logging_steps, global_step)
                     logger.info("Average loss: %s at global step: %s", str((tr_loss - logging_loss)/args.logging_steps), str(global_step))
                     logging_loss = tr_loss
 
                 if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
-                    # Save model checkpoint
-                    output_dir = os.path.join(args.output_dir, 'checkpoint-{}'.format(global_step))
-                    if not os.path.exists(output_dir):
-                        os.makedirs(output_dir)
+                    # Save a resumable checkpoint, written in the background from a CPU copy
                     model_to_save = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
-                    model_to_save.save_pretrained(output_dir)
-                    tokenizer.save_vocabulary(output_dir)
-                    torch.save(args, os.path.join(output_dir, 'training_args.bin'))
-                    logger.info("Saving model checkpoint to %s", output_dir)
+                    files = training_snapshot(model_to_save, optimizer, scheduler,
+                                              global_step=global_step, epoch=epoch_idx, step=step,
+                                              tr_loss=tr_loss, logging_loss=logging_loss,
+                                              epoch_rng_state=epoch_rng_state)
+                    files['training_args.bin'] = copy.copy(args)
+                    checkpoint_writer.save(os.path.join(args.output_dir, 'checkpoint-{}'.format(global_step)),
+                                           files, config=model_to_save.config, tokenizer=tokenizer)
 
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
+        if resume_state is not None:
+            # the checkpoint was taken on the last batch of its epoch
+            set_rng_state(resume_state['rng'])
+            resume_state = None
         if args.max_steps > 0 and global_step > args.max_steps:
             train_iterator.close()
             break
 
     if args.local_rank in [-1, 0]:
         tb_writer.close()
+        checkpoint_writer.close()
+    if eval_worker is not None:
+        eval_worker.close()
 
-    return global_step, tr_loss / global_step, best_steps
+    return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, prefix=""):
+def evaluate(args, model, tokenizer, prefix="", eval_dataset=None):
     eval_task = args.task_name
-    eval_outputs_dir = args.output_dir
+    eval_output_dir = args.output_dir
+    results = {}
 
-    eval_dataset = load_and_cache_examples(args, eval_task, tokenizer, evaluate=True)
+    if eval_dataset is None:
+        eval_dataset = load_and_cache_examples(args, eval_task, tokenizer, evaluate=True)
     if not os.path.exists(eval_output_dir) and args.local_rank in [-1, 0]:
         os.makedirs(eval_output_dir)
   
@@ -203,7 +262,7 @@ def evaluate(args, model, tokenizer, prefix=""):
     out_label_ids = None
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
         model.eval()
-        batch = tuple(t.to(args.device) for t in batch)
+        batch = tuple(t.to(args.device).long() for t in batch)
 
         with torch.no_grad():
             inputs = {'input_ids':      batch[0],
@@ -244,51 +303,19 @@ def evaluate(args, model, tokenizer, prefix=""):
     return results
 
 
-def predict(args, model, tokenizer, examples):
-    predict_processors = processors['duqa']()
-    predict_examples = predict_processors.get_predict_examples(examples)
-    predict_features = convert_examples_to_features(
-        examples=predict_examples,
-        label_list=predict_processors.get_labels(),
-        max_seq_length=args.max_seq_length,
-        tokenizer=tokenizer
-    )
-    all_input_ids = torch.tensor([f.input_ids for f in predict_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in predict_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in predict_features], dtype=torch.long)
-    predict_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids)
-
-    args.predict_batch_size = args.per_gpu_predict_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    predict_sampler = SequentialSampler(predict_data) if args.local_rank == -1 else DistributedSampler(dataset)
-    predict_dataloader = DataLoader(predict_data, sampler=predict_sampler, batch_size=args.predict_batch_size)
-
-    # Predict!
-    logger.info("***** Running prediction *****")
-    logger.info("  Num examples = %d", len(predict_data))
-    logger.info("  Batch size = %d", args.predict_batch_size)
-    logitslist = []
-    for batch in tqdm(predict_dataloader, desc="Predicting"):
-        model.eval()
-        batch = tuple(t.to(args.device) for t in batch)
-        with torch.no_grad():
-            inputs = {'input_ids':      batch[0],
-                      'attention_mask': batch[1],
-                      'token_type_ids': batch[2]
-                      }
-            outputs = model(**inputs)
-            logits = outputs[0]
-
-            logitslist.append(logits)
+_eval_dataset = None
 
-    final_logits = torch.cat(logitslist, dim=0)
-    assert len(final_logits) == len(examples)
-    result = {}
-    
-    for index, example in enumerate(examples):
-        result[example['question_id']] = [round(final_logits[index][0].item(), 4), round(final_logits[index][1].item(), 4)]
 
-    return result
+def evaluate_checkpoint(args, checkpoint_dir, tokenizer, global_step):
+    """Dev accuracy / loss of a step checkpoint, run by the utils.eval_worker process."""
+    global _eval_dataset
+    eval_args = copy.copy(args)
+    eval_args.output_dir = os.path.join(args.output_dir, 'eval')
+    if _eval_dataset is None:
+        _eval_dataset = load_and_cache_examples(eval_args, args.task_name, tokenizer, evaluate=True)
+    model = MODEL_CLASSES[args.model_type][1].from_pretrained(checkpoint_dir)
+    model.to(args.device)
+    return evaluate(eval_args, model, tokenizer, prefix=str(global_step), eval_dataset=_eval_dataset)
 
 
 def load_and_cache_examples(args, task, tokenizer, evaluate=False):
@@ -306,9 +333,11 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False):
         list(filter(None, args.model_name_or_path.split('/'))).pop(),
         str(args.max_seq_length),
         str(task)))
-    if os.path.exists(cached_features_file):
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
+    cached_features_dir = store_dir(cached_features_file)
+    columns = feature_columns(tokenizer)
+    features = None
+    if has_feature_store(cached_features_dir):
+        logger.info("Loading features from cached file %s", cached_features_dir)
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
         label_list = processor.get_labels()
@@ -317,24 +346,37 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False):
         else:
             examples = processor.get_train_examples(args.data_dir)
         logger.info("Training number: %s", str(len(examples)))
-        features = convert_examples_to_features(examples, label_list, args.max_seq_length, tokenizer)
+        features = convert_examples_to_features(examples, label_list, args.max_seq_length, tokenizer,
+                                                num_workers=args.preprocess_workers)
         if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
+            logger.info("Saving features into cached file %s", cached_features_dir)
+            write_feature_store(cached_features_dir, features, columns, args.max_seq_length)
 
     if args.local_rank == 0:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
-
-    dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+    # Build the dataset over the mapped columns (int16 / uint8, cast to long per batch in train / evaluate)
+    names = ['input_ids', 'input_mask', 'segment_ids', 'label_id']
+    if has_feature_store(cached_features_dir):
+        tensors = load_feature_store(cached_features_dir, names)
+    else:
+        tensors = feature_tensors(features, columns, args.max_seq_length, names)
+    dataset = TensorDataset(*tensors)
     return dataset
 
 
+def load_stream(args, task, tokenizer):
+    """Streaming training set over the train_labeled*.json shards of data_dir."""
+    return JsonlStream(list_shards(os.path.join(args.data_dir, 'train_labeled*.json')), stream_features,
+                       shuffle_buffer_size=args.shuffle_buffer_size,
+                       seed=args.seed,
+                       rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+                       world_size=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+                       processor=processors[task](),
+                       max_seq_length=args.max_seq_length,
+                       tokenizer=fast_tokenizer(tokenizer))
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -365,7 +407,7 @@ def main():
     parser.add_argument("--do_eval", action='store_true',
                         help="Whether to run eval on the dev set.")
     parser.add_argument("--evaluate_during_training", action='store_true',
-                        help="Rul evaluation during training at each logging step.")
+                        help="Evaluate the step checkpoints (see --save_steps) in a background process during training.")
     parser.add_argument("--do_lower_case", action='store_true',
                         help="Set this flag if you are using an uncased model.")
 
@@ -394,6 +436,11 @@ def main():
                         help="Log every X updates steps.")
     parser.add_argument('--save_steps', type=int, default=50,
                         help="Save checkpoint every X updates steps.")
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help="Keep only the last X step checkpoints, 0 (default) keeps them all, "
+                             "as --eval_all_checkpoints needs")
+    parser.add_argument('--resume_from', default=None, type=str,
+                        help="Step checkpoint to resume training from, 'latest' for the last one in output_dir")
     parser.add_argument("--eval_all_checkpoints", action='store_true',
                         help="Evaluate all checkpoints starting with the same prefix as model_name ending and ending with step number")
     parser.add_argument("--no_cuda", action='store_true',
@@ -402,6 +449,14 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help="Number of processes converting examples to features (DataLoader workers with --streaming)")
+    parser.add_argument('--bucket_size', type=int, default=100,
+                        help="Training batches per length bucket (batches hold windows of similar length), 0 samples at random")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Stream the training set from JSONL shards instead of caching its features, needs --max_steps")
+    parser.add_argument('--shuffle_buffer_size', type=int, default=10000,
+                        help="Training items held in the shuffle buffer of each streaming reader")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
 
@@ -414,7 +469,7 @@ def main():
                         help="For distributed training: local_rank")
     args = parser.parse_args()
 
-    if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and args.do_train and not args.overwrite_output_dir:
+    if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and args.do_train and not args.overwrite_output_dir and not args.resume_from:
         raise ValueError("Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(args.output_dir))
 
     # Setup CUDA, GPU & distributed training
@@ -462,12 +517,14 @@ def main():
     model.to(args.device)
 
     logger.info("Training/evaluation parameters %s", args)
-    best_steps = 0
 
     # Training
     if args.do_train:
-        train_dataset = load_and_cache_examples(args, args.task_name, tokenizer, evaluate=False)
-        global_step, tr_loss, best_steps = train(args, train_dataset, model, tokenizer)
+        if args.streaming:
+            train_dataset = load_stream(args, args.task_name, tokenizer)
+        else:
+            train_dataset = load_and_cache_examples(args, args.task_name, tokenizer, evaluate=False)
+        global_step, tr_loss = train(args, train_dataset, model, tokenizer)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
     # Saving best-practices: if you use defaults names for the model, you can reload it using from_pretrained()
@@ -509,8 +566,6 @@ def main():
             result = evaluate(args, model, tokenizer, prefix=global_step)
             result = dict((k + '_{}'.format(global_step), v) for k, v in result.items())
             results.update(result)
-    if best_steps:
-        logger.info("best steps of eval acc is the following checkpoints: %s", best_steps)
     return results
 
 
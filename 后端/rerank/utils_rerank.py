@@ -9,10 +9,12 @@ import logging
 import math
 from io import open
 
-from tqdm import tqdm
-
+import numpy as np
 from transformers.tokenization_bert import BasicTokenizer, whitespace_tokenize
 
+from utils.parallel import map_chunks
+from utils.tokenization import fast_tokenizer
+
 logger = logging.getLogger(__name__)
 
 
@@ -37,6 +39,15 @@ class InputFeatures(object):
         self.label_id = label_id
 
 
+def feature_columns(tokenizer):
+    """(attribute, dtype) of the cached `InputFeatures` columns, see utils.feature_store."""
+    from utils.feature_store import ids_dtype  # training only, keep it out of the server import path
+    return [('input_ids', ids_dtype(len(tokenizer))),
+            ('input_mask', np.uint8),
+            ('segment_ids', np.uint8),
+            ('label_id', np.int16)]
+
+
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
 
@@ -118,11 +129,27 @@ class DuQAProcessor(DataProcessor):
         return examples_list
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer):
+def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, pad_to_max_length=True,
+                                 num_workers=1):
+    """
+    pad_to_max_length=False keeps every pair at its real length, the predict
+    loop then pads per batch (see utils.batching.pad_sequences).
+    num_workers > 1 converts ordered chunks of examples on a process pool.
+    """
+    return map_chunks(_convert_examples_chunk, examples,
+                      num_workers=num_workers,
+                      desc='loading_data',
+                      label_list=label_list,
+                      max_seq_length=max_seq_length,
+                      tokenizer=fast_tokenizer(tokenizer),
+                      pad_to_max_length=pad_to_max_length)
+
+
+def _convert_examples_chunk(examples, ex_offset, label_list, max_seq_length, tokenizer, pad_to_max_length=True):
     label_map = {label : i for i, label in enumerate(label_list)}
     
     features = []
-    for (ex_index, example) in tqdm(enumerate(examples), desc='loading_data'):
+    for (ex_index, example) in enumerate(examples, ex_offset):
         tokens_a = tokenizer.tokenize(example.text_a)
 
         tokens_b = None
@@ -143,14 +170,16 @@ def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer
         input_ids = tokenizer.convert_tokens_to_ids(tokens)
         input_mask = [1] * len(input_ids)
 
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
+        if pad_to_max_length:
+            padding = [0] * (max_seq_length - len(input_ids))
+            input_ids += padding
+            input_mask += padding
+            segment_ids += padding
 
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+            assert len(input_ids) == max_seq_length
+        assert len(input_ids) <= max_seq_length
+        assert len(input_mask) == len(input_ids)
+        assert len(segment_ids) == len(input_ids)
 
         label_id = label_map[example.label]
         # if ex_index < 5:
@@ -172,6 +201,16 @@ def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer
     return features
 
 
+def stream_features(example, processor, max_seq_length, tokenizer):
+    """
+    The training pair of one json line as an (input_ids, input_mask, segment_ids, label_id)
+    tuple: the build_fn of a `utils.streaming.JsonlStream`.
+    """
+    examples = processor._create_examples([example], 'train')
+    features = _convert_examples_chunk(examples, 0, processor.get_labels(), max_seq_length, tokenizer)
+    return [(f.input_ids, f.input_mask, f.segment_ids, f.label_id) for f in features]
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
 
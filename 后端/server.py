@@ -1,32 +1,46 @@
+import time
+_import_start = time.time()
+
 import argparse
-import glob
+import contextlib
 import json
 import logging
 import math
 import os
-import random
 import re
 import sys
 
 import jieba
 from flask_cors import CORS
-import numpy as np
 import torch
-from flask import Flask, jsonify, request
-from flask_restful import Api, Resource, reqparse
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
-from torch.utils.data.distributed import DistributedSampler
-from tqdm import tqdm, trange
-
-from creeper import creeper_v1, creeper_v2
-from mrc import mrc_MODEL_CLASSES, mrc_predict, set_seed, to_list
+from flask import Flask, Response, jsonify, request, stream_with_context
+
+# creeper 只导入轻量的包装, bs4/lxml/requests 在第一次抓取时才导入
+from creeper import (configure_crawl_cache, creeper_v1, creeper_v1_iter,
+                     creeper_v2, creeper_v2_iter)
+from models.jit import TracedModel
+from models.mmap_weights import has_mmap_weights, load_mmap_model
+from models.onnx_backend import OnnxModel
+from models.quantization import load_quantized
+from mrc import (mrc_MODEL_CLASSES, mrc_predict, mrc_predict_logits, set_seed,
+                 tokenize_doc)
 from rerank import rerank_MODEL_CLASSES, rerank_predict
+from serving import (AnswerCache, DocStore, DynamicBatcher, Stage, StageStats,
+                     background_iter, log_pipeline_stats, serve_prefork)
+from utils.cache import LRUCache
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
+logger.info("Startup phase imports took %.2fs", time.time() - _import_start)
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    start = time.time()
+    yield
+    logger.info("Startup phase %s took %.2fs", name, time.time() - start)
 
 
 class Args(object):
@@ -35,10 +49,51 @@ class Args(object):
             self.__dict__[key] = value
 
 
+def load_model(args, model_class, config, token_level):
+    """
+    Load the inference model selected by args.backend:
+    - eager (default): the transformers model
+    - torchscript: graphs traced per length in args.jit_buckets, cached next to the checkpoint
+    args.quantize: dynamic int8 linear layers (CPU only), cached next to the checkpoint
+    An OnnxModel (model_type bert_onnx) is always loaded from model.onnx as is.
+    """
+    quantize = getattr(args, 'quantize', False)
+    backend = getattr(args, 'backend', 'eager')
+    onnx = issubclass(model_class, OnnxModel)
+    if onnx and quantize:
+        raise ValueError("quantize does not apply to bert_onnx, set \"quantize\": false")
+    if onnx and backend != 'eager':
+        raise ValueError("bert_onnx runs on onnxruntime, set \"backend\": \"eager\"")
+    if quantize and args.device.type != 'cpu':
+        raise ValueError("quantize only runs on CPU, set no_cuda in the config")
+
+    def build_model():
+        if onnx:
+            return model_class.from_pretrained(args.model_name_or_path)
+        if quantize:
+            return load_quantized(args.model_name_or_path, model_class, config)
+        if has_mmap_weights(args.model_name_or_path) and args.device.type == 'cpu':
+            # converted by convert_weights.py: no unpickling, pages are loaded on demand
+            return load_mmap_model(model_class, args.model_name_or_path, config)
+        model = model_class.from_pretrained(args.model_name_or_path, from_tf=bool('.ckpt' in args.model_name_or_path), config=config)
+        model.to(args.device)
+        return model
+
+    if backend == 'torchscript':
+        buckets = getattr(args, 'jit_buckets', [args.max_seq_length])
+        return TracedModel.load_or_trace(args.model_name_or_path, build_model, buckets,
+                                         args.device, token_level=token_level,
+                                         traced_dir='torchscript_int8' if quantize else 'torchscript')
+    if backend != 'eager':
+        raise ValueError("Unknown backend: %s" % backend)
+    return build_model()
+
+
 class Mrc(object):
     """
     ADD KEYS:
     answer: string
+    answer_span: [int, int]
     mrc_logits: float 
     """    
     def __init__(self, config: dict):
@@ -71,14 +126,25 @@ class Mrc(object):
         config_class, model_class, tokenizer_class = mrc_MODEL_CLASSES[args.model_type]
         self.config = config_class.from_pretrained(args.model_name_or_path)
         self.tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path, do_lower_case=args.do_lower_case)
-        self.model = model_class.from_pretrained(args.model_name_or_path, from_tf=bool('.ckpt' in args.model_name_or_path), config=self.config)
+        self.model = load_model(args, model_class, self.config, token_level=True)
 
         if args.local_rank == 0:
             torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
-        self.model.to(args.device)
         self.args = args
 
+        # One inference worker shared by all request threads, so windows of
+        # overlapping requests are run in the same forward pass.
+        self.batcher = None
+        if getattr(args, 'dynamic_batching', False):
+            self.batcher = DynamicBatcher(
+                lambda features: mrc_predict_logits(self.args, self.model, features),
+                max_batch_size=args.per_gpu_predict_batch_size * max(1, args.n_gpu),
+                max_wait_ms=getattr(args, 'batch_wait_ms', 5))
+
+        # WordPiece tokens/ids of recently seen documents, keyed by content hash
+        self.doc_cache = LRUCache(maxsize=getattr(args, 'doc_cache_size', 256))
+
         logger.info("Training/evaluation parameters %s", args)
 
         
@@ -126,7 +192,9 @@ class Mrc(object):
             }
         ]       
         """
-        all_predictions, all_nbest_json = mrc_predict(self.args, self.model, self.tokenizer, examples)
+        forward_fn = self.batcher.submit if self.batcher is not None else None
+        all_predictions, all_nbest_json = mrc_predict(self.args, self.model, self.tokenizer, examples,
+                                                      forward_fn=forward_fn, doc_cache=self.doc_cache)
         assert len(all_predictions) == len(examples)
         assert len(all_nbest_json) == len(examples)
         for example in examples:
@@ -135,6 +203,8 @@ class Mrc(object):
             problist = [var['start_prob'] * var['end_prob'] for var in all_nbest_json[qid]]
             problist_v1 = [var['start_prob_v1'] * var['end_prob_v1'] for var in all_nbest_json[qid]]
             example['answer'] = all_predictions[qid].replace('\n', '').replace(' ', '').strip()
+            # [start, end) char offsets of the raw answer in content ("".join(doc_tokens)), None if unknown
+            example['answer_span'] = [all_nbest_json[qid][0]['start_char'], all_nbest_json[qid][0]['end_char']]
             example['mrc_logits'] = sum(logitslist)/len(logitslist)
             example['mrc_prob'] = sum(problist)/len(problist)
             example['mrc_prob_v1'] = sum(problist_v1)/len(problist_v1)
@@ -176,19 +246,21 @@ class Rerank(object):
         config_class, model_class, tokenizer_class = rerank_MODEL_CLASSES[args.model_type]
         self.config = config_class.from_pretrained(args.model_name_or_path)
         self.tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path, do_lower_case=args.do_lower_case)
-        self.model = model_class.from_pretrained(args.model_name_or_path, from_tf=bool('.ckpt' in args.model_name_or_path), config=self.config)
+        self.model = load_model(args, model_class, self.config, token_level=False)
 
         if args.local_rank == 0:
             torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
-        self.model.to(args.device)
         self.args = args
+        # 最近 (question, answer) 的打分, 重复的答案不再过模型
+        self.score_cache = LRUCache(maxsize=getattr(args, 'score_cache_size', 4096))
 
         logger.info("Training/evaluation parameters %s", args)
 
 
     def predict(self, examples):
-        all_rerank_logits = rerank_predict(self.args, self.model, self.tokenizer, examples)
+        all_rerank_logits = rerank_predict(self.args, self.model, self.tokenizer, examples,
+                                           score_cache=self.score_cache)
         assert len(all_rerank_logits) == len(examples)
         for example in examples:
             qid = example['question_id']
@@ -253,13 +325,28 @@ class Choose(object):
 class Demo(object):
     def __init__(self, config_path):
         self.server_config = json.loads(open(config_path).read())
-        self.mrc_processor = Mrc(self.server_config)
-        self.rerank_processor = Rerank(self.server_config)
+        with startup_phase('mrc model'):
+            self.mrc_processor = Mrc(self.server_config)
+        with startup_phase('rerank model'):
+            self.rerank_processor = Rerank(self.server_config)
+        with startup_phase('jieba dictionary'):
+            # 否则词典在第一个请求里才加载
+            jieba.initialize()
         self.choose_processor = Choose()
+        self.answer_cache = None
+        if "answer_cache" in self.server_config:
+            self.answer_cache = AnswerCache(self.server_config["answer_cache"])
+        self.doc_store = None
+        if "doc_store" in self.server_config:
+            self.doc_store = DocStore(self.server_config["doc_store"]["path"])
+        if "crawl_cache" in self.server_config:
+            configure_crawl_cache(self.server_config["crawl_cache"])
         if self.server_config["creeper"]["creeper_type"] == 'v1':
             self.creeper = creeper_v1
+            self.creeper_iter = creeper_v1_iter
         else:
             self.creeper = creeper_v2
+            self.creeper_iter = creeper_v2_iter
         self.keys = [
             "question_id",
             "question",
@@ -268,10 +355,18 @@ class Demo(object):
             "source_link",
             "content",
             "answer",
+            "answer_span",
             "final_prob",
             "final_prob_v1"
         ]
 
+    def share_memory(self):
+        """Move the CPU model weights to shared memory before forking workers."""
+        for processor in [self.mrc_processor, self.rerank_processor]:
+            # mmap weights are already shared through the page cache
+            if processor.args.device.type == 'cpu' and not getattr(processor.model, 'mmap_weights', False):
+                processor.model.share_memory()
+
     def filter(self, examples, keys):
         new_examples = []
         for example in examples:
@@ -283,16 +378,54 @@ class Demo(object):
         return new_examples
 
     def predict(self, query):
-        # 读取一个问题的5篇文档
-        examples = self.creeper(query)
-        # 预测5个文档的答案
-        examples = self.mrc_processor.predict(examples)
+        for event, data in self.predict_stream(query):
+            if event == 'ranked':
+                return data
+
+    def predict_stream(self, query):
+        """
+        Yield ('answer', partial) for each document as soon as its MRC answer is
+        decoded, then ('ranked', examples) once rerank and Choose are done.
+        """
+        if self.answer_cache is not None:
+            examples = self.answer_cache.get(query)
+            if examples is not None:
+                yield 'ranked', examples
+                return
+        start_time = time.time()
+        crawl_stats = StageStats('crawl')
+        mrc_stats = StageStats('mrc')
+        # 每篇文档的答案一解码出来就交给 rerank 线程, rerank 与剩余文档的 MRC 重叠
+        rerank_stage = Stage('rerank', self.rerank_processor.predict)
+        # 读取一个问题的5篇文档, 每篇文档一爬到就预测它的答案, MRC 与爬虫重叠
+        try:
+            for example in background_iter(self.creeper_iter(query), stats=crawl_stats):
+                with mrc_stats.busy():
+                    examples = self.mrc_processor.predict([example])
+                rerank_stage.put(examples)
+                for example in examples:
+                    yield 'answer', {
+                        'question_id': example['question_id'],
+                        'title': example.get('title'),
+                        'source_link': example.get('source_link'),
+                        'answer': self.choose_processor.clean_answer(example['answer']),
+                        'answer_span': example['answer_span'],
+                        'mrc_prob': example['mrc_prob']
+                    }
+        except BaseException:  # also when the client of a stream goes away
+            rerank_stage.close()
+            raise
         # 获得文档的置信度
-        examples = self.rerank_processor.predict(examples)
+        examples = rerank_stage.join()
+        log_pipeline_stats([crawl_stats, mrc_stats, rerank_stage.stats], start_time)
+        # 文档按爬取完成的顺序到达, 恢复搜索排名的顺序
+        examples = sorted(examples, key=lambda x: x['question_id'])
         # 计算最终的答案置信度
         examples = self.choose_processor.process(examples)
         examples = self.filter(examples, self.keys)
-        return examples
+        if self.answer_cache is not None and examples:
+            self.answer_cache.set(query, examples)
+        yield 'ranked', examples
 
     def predict_v2(self, querys: list, doc: str):
         examples = []
@@ -310,6 +443,40 @@ class Demo(object):
         examples = self.filter(examples, self.keys)
         return examples
 
+    def _get_doc_store(self):
+        if self.doc_store is None:
+            raise ValueError("doc_store is not configured")
+        return self.doc_store
+
+    def add_doc(self, title: str, text: str):
+        # 分词和 WordPiece 只在上传时做一次, 之后的提问直接复用
+        doc_tokens = list(jieba.cut(text))
+        doc_features = tokenize_doc(doc_tokens, self.mrc_processor.tokenizer)
+        return self._get_doc_store().add(title, text, doc_tokens, doc_features)
+
+    def list_docs(self):
+        return self._get_doc_store().list()
+
+    def remove_doc(self, _id: str):
+        return self._get_doc_store().remove(_id)
+
+    def predict_doc(self, _id: str, query: str):
+        doc = self._get_doc_store().get(_id)
+        if doc is None:
+            raise KeyError("no document with _id {}".format(_id))
+        doc_tokens, doc_features = doc
+        example = {
+            'question_id': 0,
+            'question': query,
+            'doc_tokens': doc_tokens,
+            'doc_features': doc_features
+        }
+        examples = self.mrc_processor.predict([example])
+        for example in examples:
+            example['answer'] = self.choose_processor.clean_answer(example['answer'])
+        examples = self.filter(examples, self.keys)
+        return examples[0]
+
     def predict_v3(self, query: str, docs: list):
         examples = []
         for index, doc in enumerate(docs):
@@ -340,9 +507,14 @@ if __name__ == "__main__":
                         help="config json")
     parser.add_argument("--port", default=None, type=int, required=True,
                         help="config json")
+    parser.add_argument("--workers", default=0, type=int,
+                        help="Fork this many worker processes sharing the loaded models, 0 to serve from this process")
+    parser.add_argument("--torch_threads", default=0, type=int,
+                        help="torch intra-op threads per process, 0 to keep torch's default")
     args = parser.parse_args()
 
-    D = Demo(args.config_path)
+    with startup_phase('total'):
+        D = Demo(args.config_path)
 
     @app.route('/api/chat', methods=['POST', 'GET'])
     def func1():
@@ -356,16 +528,49 @@ if __name__ == "__main__":
         except Exception as e:
             return json.dumps({'code': 1, 'messge': str(e)})
 
-    @app.route('/api/doc', methods=['POST'])
+    @app.route('/api/chat_stream', methods=['POST', 'GET'])
+    def func1_stream():
+        """Server-sent events: one `answer` event per document, then the `ranked` results."""
+        if request.method == 'POST':
+            query = request.get_json()['message']
+        else:
+            query = request.args.get('query')
+
+        def events():
+            try:
+                for event, data in D.predict_stream(query):
+                    yield 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data, ensure_ascii=False))
+            except Exception as e:
+                yield 'event: error\ndata: {}\n\n'.format(json.dumps({'message': str(e)}, ensure_ascii=False))
+
+        return Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @app.route('/api/cache_stats', methods=['GET'])
+    def cache_stats():
+        stats = D.answer_cache.stats() if D.answer_cache is not None else {}
+        return json.dumps({'code': 0, 'results': stats}, ensure_ascii=False)
+
+    @app.route('/api/doc', methods=['GET', 'POST', 'DELETE'])
     def func2():
         try:
-            if request.method == 'POST':
-                inputs = request.get_json()
-                querys = inputs['query']
-                doc = inputs['doc']
+            # 文档库: 前端的 fetchDocs / uploadDoc / removeDoc
+            if request.method == 'GET':
+                return json.dumps({'code': 0, 'data': D.list_docs()}, ensure_ascii=False)
+            inputs = request.get_json()
+            if request.method == 'DELETE':
+                D.remove_doc(inputs['_id'])
+                return json.dumps({'code': 0})
+            if 'text' in inputs:
+                _id = D.add_doc(inputs.get('title', ''), inputs['text'])
+                return json.dumps({'code': 0, 'data': {'_id': _id}})
+            # 直接传文档原文的提问
+            querys = inputs['query']
+            doc = inputs['doc']
             return json.dumps({'code': 0, 'results': D.predict_v2(querys, doc)}, ensure_ascii=False)
         except Exception as e:
-            return json.dumps({'code': 1, 'messge': str(e)})
+            # the frontend reads 'message'
+            return json.dumps({'code': 1, 'messge': str(e), 'message': str(e)}, ensure_ascii=False)
 
     @app.route('/api/doc_qa', methods=['POST'])
     def func3():
@@ -373,10 +578,20 @@ if __name__ == "__main__":
             if request.method == 'POST':
                 inputs = request.get_json()
                 query = inputs['query']
+                # 对文档库中的文档提问
+                if '_id' in inputs:
+                    return json.dumps({'code': 0, 'data': D.predict_doc(inputs['_id'], query)}, ensure_ascii=False)
                 docs = inputs['docs']
             return json.dumps({'code': 0, 'results': D.predict_v3(query, docs)}, ensure_ascii=False)
         except Exception as e:
-            return json.dumps({'code': 1, 'messge': str(e)})
+            # the frontend reads 'message'
+            return json.dumps({'code': 1, 'messge': str(e), 'message': str(e)}, ensure_ascii=False)
 
 
-    app.run(host="127.0.0.1", port=args.port, threaded=True)
+    if args.workers > 0:
+        D.share_memory()
+        serve_prefork(app, "127.0.0.1", args.port, args.workers, torch_threads=args.torch_threads)
+    else:
+        if args.torch_threads > 0:
+            torch.set_num_threads(args.torch_threads)
+        app.run(host="127.0.0.1", port=args.port, threaded=True)
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+""" Serving-side helpers shared by server.py. """
+
+from .answer_cache import AnswerCache, normalize_query
+from .batcher import DynamicBatcher
+from .doc_store import DocStore
+from .pipeline import (Stage, StageStats, background_iter,
+                       log_pipeline_stats)
+from .prefork import serve_prefork
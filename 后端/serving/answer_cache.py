@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+""" Two-level cache of /api/chat answers keyed by the normalized query. """
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import re
+import unicodedata
+
+from utils.cache import LRUCache, SqliteCache
+
+logger = logging.getLogger(__name__)
+
+_TRAILING_PUNCTUATION = '?？!！。.~～ '
+
+
+def normalize_query(query):
+    """
+    Cache key of a query: full-width forms folded to half-width (NFKC),
+    lower-cased, whitespace removed and trailing `？`/`。`-like punctuation stripped.
+    """
+    query = unicodedata.normalize('NFKC', query).lower()
+    query = re.sub(r'\s+', '', query)
+    return query.rstrip(_TRAILING_PUNCTUATION)
+
+
+class AnswerCache(object):
+    """
+    L1: in-process LRU with TTL. L2 (optional): an SQLite file shared by all
+    worker processes. L2 hits are promoted to L1.
+
+    config:
+    {
+        "max_entries": int, L1 size
+        "ttl": seconds, L1 ttl
+        "shared_path": path of the L2 file, omit to disable L2
+        "shared_ttl": seconds, L2 ttl
+        "shared_max_entries": int, L2 size
+    }
+    """
+
+    def __init__(self, config):
+        self.local = LRUCache(maxsize=config.get('max_entries', 1024), ttl=config.get('ttl', 3600))
+        self.shared = None
+        if config.get('shared_path'):
+            self.shared = SqliteCache(config['shared_path'],
+                                      ttl=config.get('shared_ttl', 86400),
+                                      max_entries=config.get('shared_max_entries', 100000))
+
+    def get(self, query):
+        key = normalize_query(query)
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, query, value):
+        key = normalize_query(query)
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def stats(self):
+        stats = {'local': self.local.stats.to_dict()}
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats.to_dict()
+        return stats
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+""" Cross-request dynamic micro-batching for model inference. """
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class _Request(object):
+    """The windows submitted by one caller and the slots their outputs go to."""
+
+    def __init__(self, windows):
+        self.windows = windows
+        self.outputs = [None] * len(windows)
+        self.scheduled = 0  # windows already handed to the worker
+        self.finished = 0   # windows whose output has been written back
+        self.future = Future()
+
+
+class DynamicBatcher(object):
+    """
+    A single inference worker in front of a model.
+
+    Concurrent callers `submit` their feature windows; the worker collects windows
+    from all pending requests into batches of at most `max_batch_size`, waiting at
+    most `max_wait_ms` for a batch to fill up, runs `forward_fn` once per batch and
+    routes each output back to the caller that submitted the window.
+
+    forward_fn: callable mapping a list of windows to a list of outputs (same order).
+    """
+
+    def __init__(self, forward_fn, max_batch_size, max_wait_ms=5):
+        self.forward_fn = forward_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000.0)
+
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        self._worker = None
+        self._worker_pid = None
+
+    def submit(self, windows):
+        """Block until every window has been run and return their outputs in order."""
+        if not windows:
+            return []
+        request = _Request(list(windows))
+        with self._cond:
+            self._ensure_worker()
+            self._pending.append(request)
+            self._cond.notify()
+        return request.future.result()
+
+    def _ensure_worker(self):
+        # Threads do not survive fork(): (re)start the worker lazily in every process.
+        if self._worker is not None and self._worker_pid == os.getpid() and self._worker.is_alive():
+            return
+        self._worker_pid = os.getpid()
+        self._worker = threading.Thread(target=self._run, name='DynamicBatcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _queued_windows(self):
+        return sum(len(r.windows) - r.scheduled for r in self._pending)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            # Give concurrent requests a short window to join this batch.
+            deadline = time.time() + self.max_wait
+            while self._queued_windows() < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = []
+            while self._pending and len(batch) < self.max_batch_size:
+                request = self._pending[0]
+                take = min(self.max_batch_size - len(batch), len(request.windows) - request.scheduled)
+                batch.extend((request, i) for i in range(request.scheduled, request.scheduled + take))
+                request.scheduled += take
+                if request.scheduled == len(request.windows):
+                    self._pending.popleft()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outputs = self.forward_fn([request.windows[i] for request, i in batch])
+                assert len(outputs) == len(batch)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception("Batched forward pass failed")
+                self._fail({request for request, _ in batch}, e)
+                continue
+
+            for (request, i), output in zip(batch, outputs):
+                request.outputs[i] = output
+                request.finished += 1
+                if request.finished == len(request.windows) and not request.future.done():
+                    request.future.set_result(request.outputs)
+
+    def _fail(self, requests, error):
+        with self._cond:
+            for request in requests:
+                if request in self._pending:
+                    self._pending.remove(request)
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(error)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+""" Persistent store of the documents uploaded through /api/doc. """
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import pickle
+import sqlite3
+import time
+import uuid
+
+from utils.cache import LRUCache, SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class DocStore(SqliteStore):
+    """
+    Uploaded documents with their jieba tokens and `DocFeatures` (WordPiece
+    tokens, ids and offset maps), computed once on upload so that questions
+    about a stored document skip all text processing.
+
+    The SQLite file can be shared by several worker processes; recently
+    asked documents are also kept unpickled in memory.
+    """
+
+    def __init__(self, path, cache_size=64):
+        super(DocStore, self).__init__(path)
+        self._loaded = LRUCache(maxsize=cache_size)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS docs ("
+                         "_id TEXT PRIMARY KEY, title TEXT, text TEXT, created REAL, "
+                         "doc_tokens BLOB, doc_features BLOB)")
+
+    def add(self, title, text, doc_tokens, doc_features):
+        _id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute("INSERT INTO docs (_id, title, text, created, doc_tokens, doc_features) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (_id, title, text, time.time(),
+                          sqlite3.Binary(pickle.dumps(doc_tokens, protocol=pickle.HIGHEST_PROTOCOL)),
+                          sqlite3.Binary(pickle.dumps(doc_features, protocol=pickle.HIGHEST_PROTOCOL))))
+        return _id
+
+    def list(self):
+        rows = self._connect().execute("SELECT _id, title, text, created FROM docs ORDER BY created DESC")
+        return [{'_id': _id, 'title': title, 'text': text, 'created': created}
+                for _id, title, text, created in rows]
+
+    def remove(self, _id):
+        with self._connect() as conn:
+            deleted = conn.execute("DELETE FROM docs WHERE _id = ?", (_id,)).rowcount
+        self._loaded.delete(_id)
+        return deleted > 0
+
+    def get(self, _id):
+        """Return (doc_tokens, doc_features) of a stored document, or None."""
+        loaded = self._loaded.get(_id)
+        if loaded is not None:
+            return loaded
+        row = self._connect().execute("SELECT doc_tokens, doc_features FROM docs WHERE _id = ?",
+                                      (_id,)).fetchone()
+        if row is None:
+            return None
+        loaded = (pickle.loads(bytes(row[0])), pickle.loads(bytes(row[1])))
+        self._loaded.set(_id, loaded)
+        return loaded
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+""" Helpers to overlap the stages of the QA pipeline. """
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class StageStats(object):
+    """Busy time, processed items and max queue depth of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_time = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def busy(self, items=1):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.busy_time += time.time() - start
+                self.items += items
+
+    def observe_queue(self, depth):
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def __str__(self):
+        return "%s: items=%d busy=%.3fs max_queue_depth=%d" % (
+            self.name, self.items, self.busy_time, self.max_queue_depth)
+
+
+def log_pipeline_stats(stats, start_time):
+    """Log each stage next to the wall time; busy times summing past it means the stages overlapped."""
+    logger.info("pipeline wall=%.3fs | %s", time.time() - start_time, " | ".join(str(s) for s in stats))
+
+
+def background_iter(iterable, maxsize=0, stats=None):
+    """
+    Drive `iterable` in a background thread and yield its items as they arrive,
+    so that the producer (e.g. the crawler) keeps working while the consumer
+    processes the items it already has. Exceptions are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize)
+    stats = stats if stats is not None else StageStats('background')
+
+    def _produce():
+        try:
+            iterator = iter(iterable)
+            while True:
+                with stats.busy():
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                items.put((item, None))
+                stats.observe_queue(items.qsize())
+        except Exception as e:  # pylint: disable=broad-except
+            items.put((_DONE, e))
+            return
+        items.put((_DONE, None))
+
+    producer = threading.Thread(target=_produce, name='background_iter')
+    producer.daemon = True
+    producer.start()
+
+    while True:
+        item, error = items.get()
+        if item is _DONE:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+
+class Stage(object):
+    """
+    A worker thread that applies `fn` to the items `put` into it.
+
+    Whatever is queued when the worker wakes up is handed to `fn` as one list,
+    so `fn` must map a list of items to a list of results. `join` closes the
+    stage and returns all results (in processing order).
+    """
+
+    def __init__(self, name, fn):
+        self.fn = fn
+        self.stats = StageStats(name)
+        self._queue = queue.Queue()
+        self._results = []
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='Stage-{}'.format(name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, items):
+        for item in items:
+            self._queue.put(item)
+        self.stats.observe_queue(self._queue.qsize())
+
+    def close(self):
+        """Let the worker exit once it has drained the queue."""
+        self._queue.put(_DONE)
+
+    def join(self):
+        self.close()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            items = [item for item in batch if item is not _DONE]
+            done = len(items) != len(batch)
+            if not items or self._error is not None:
+                continue
+            try:
+                with self.stats.busy(len(items)):
+                    self._results.extend(self.fn(items))
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception("Stage %s failed", self.stats.name)
+                self._error = e
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+""" Prefork multi-process serving with copy-on-write shared model weights. """
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import os
+import signal
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_main(app, host, port, sock, torch_threads):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+    from werkzeug.serving import make_server
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    logger.info("Worker %d serving on %s:%d", os.getpid(), host, port)
+    server.serve_forever()
+
+
+def serve_prefork(app, host, port, num_workers, torch_threads=None, min_uptime=5.0):
+    """
+    Bind the listening socket, fork `num_workers` processes that all accept on
+    it, and supervise them: a worker that exits is restarted.
+
+    Everything loaded before this call (model weights, vocab, jieba dict) is
+    shared copy-on-write with the workers, so load the models first and call
+    `share_memory()` on them, but do not run any inference in the parent: the
+    OpenMP/MKL thread pools it would start do not survive fork().
+
+    torch_threads: torch intra-op threads per worker, e.g. cores // num_workers.
+    min_uptime: a worker that dies sooner than this is restarted after a delay.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    workers = {}
+    state = {'running': True}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _worker_main(app, host, port, sock, torch_threads)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Worker %d crashed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = time.time()
+        logger.info("Started worker %d", pid)
+
+    def stop(signum, frame):
+        state['running'] = False
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(num_workers):
+        spawn()
+    logger.info("Serving on %s:%d with %d workers, %s torch threads each",
+                host, port, num_workers, torch_threads or 'default')
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            break
+        started = workers.pop(pid, None)
+        if started is None:
+            continue
+        if not state['running']:
+            continue
+        logger.warning("Worker %d exited with status %d, restarting", pid, status)
+        if time.time() - started < min_uptime:
+            time.sleep(min_uptime)
+        spawn()
+    sock.close()
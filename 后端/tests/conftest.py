@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+""" The tests import the backend packages (utils, mrc, serving, ...) from the directory above. """
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+""" DynamicBatcher: concurrent submits merged into shared forward passes. """
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+import pytest
+
+from serving.batcher import DynamicBatcher
+
+
+class RecordingModel(object):
+    """forward_fn recording its batches: window -> (window, 'out'), raises on a 'bad' window."""
+
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def __call__(self, windows):
+        with self.lock:
+            self.batches.append(list(windows))
+        if 'bad' in windows:
+            raise ValueError('bad window')
+        return [(window, 'out') for window in windows]
+
+
+def _submit_concurrently(batcher, requests):
+    """submit every request from its own thread, all at once; returns {index: outputs or exception}."""
+    results = {}
+    start = threading.Barrier(len(requests))
+
+    def caller(index, windows):
+        start.wait()
+        try:
+            results[index] = batcher.submit(windows)
+        except Exception as e:  # pylint: disable=broad-except
+            results[index] = e
+
+    threads = [threading.Thread(target=caller, args=(index, windows)) for (index, windows) in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+    return results
+
+
+def test_concurrent_submits_share_one_batch():
+    model = RecordingModel()
+    # the worker waits (up to 5s) until the 4 callers' 8 windows fill the batch
+    batcher = DynamicBatcher(model, max_batch_size=8, max_wait_ms=5000)
+    requests = [['a0', 'a1'], ['b0', 'b1', 'b2'], ['c0'], ['d0', 'd1']]
+    results = _submit_concurrently(batcher, requests)
+
+    assert len(model.batches) == 1
+    assert sorted(model.batches[0]) == sorted(window for windows in requests for window in windows)
+    for (index, windows) in enumerate(requests):
+        assert results[index] == [(window, 'out') for window in windows]
+
+
+def test_large_request_is_split_in_order():
+    model = RecordingModel()
+    batcher = DynamicBatcher(model, max_batch_size=3, max_wait_ms=0)
+    windows = list(range(7))
+    assert batcher.submit(windows) == [(window, 'out') for window in windows]
+    assert model.batches == [[0, 1, 2], [3, 4, 5], [6]]
+    assert batcher.submit([]) == []
+
+
+def test_forward_error_reaches_every_caller_of_the_batch():
+    model = RecordingModel()
+    batcher = DynamicBatcher(model, max_batch_size=4, max_wait_ms=5000)
+    results = _submit_concurrently(batcher, [['a0', 'bad'], ['b0', 'b1']])
+
+    assert len(model.batches) == 1
+    for index in (0, 1):
+        assert isinstance(results[index], ValueError)
+
+    # the worker survives: the next callers get their outputs
+    results = _submit_concurrently(batcher, [['c0'], ['d0', 'd1', 'd2']])
+    assert results == {0: [('c0', 'out')], 1: [('d0', 'out'), ('d1', 'out'), ('d2', 'out')]}
+
+
+def test_failed_request_is_not_run_further():
+    model = RecordingModel()
+    batcher = DynamicBatcher(model, max_batch_size=2, max_wait_ms=0)
+    with pytest.raises(ValueError):
+        batcher.submit([1, 'bad', 3, 4])
+    assert batcher.submit([5]) == [(5, 'out')]
+    # windows 3 and 4 were dropped with their failed request
+    assert model.batches == [[1, 'bad'], [5]]
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+""" The tensor n-best decoding against the n_best x n_best loop it replaced. """
+
+from __future__ import absolute_import, division, print_function
+
+import math
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from mrc.utils_duqa import (BaiduExample, RawResult, _compute_softmax,  # noqa: E402
+                            _nbest_predictions, convert_examples_to_features)
+from transformers import BertTokenizer  # noqa: E402
+
+DOC_CHARS = u"北京理工大学是中国共产党创办的第一所理工科大学隶属于工业和信息化部"
+
+
+def _get_best_indexes(logits, n_best_size):
+    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
+    return [index for (index, _) in index_and_score[:n_best_size]]
+
+
+def _sigmoid(x):
+    return 1 / (1 + math.exp(-x))
+
+
+def _loop_nbest(example, features, unique_id_to_result, n_best_size, max_answer_length):
+    """The former n_best x n_best loop of convert_output, over position -> value dicts."""
+    prelim_predictions = []
+    for (feature_index, feature) in enumerate(features):
+        token_to_orig_map = {feature.doc_offset + i: int(index)
+                             for (i, index) in enumerate(feature.token_to_orig_index)}
+        token_is_max_context = {feature.doc_offset + i: bool(flag)
+                                for (i, flag) in enumerate(feature.token_is_max_context)}
+        result = unique_id_to_result[feature.unique_id]
+        start_logits = result.start_logits.tolist()
+        end_logits = result.end_logits.tolist()
+        for start_index in _get_best_indexes(start_logits, n_best_size):
+            for end_index in _get_best_indexes(end_logits, n_best_size):
+                if start_index >= len(feature.tokens) or end_index >= len(feature.tokens):
+                    continue
+                if start_index not in token_to_orig_map or end_index not in token_to_orig_map:
+                    continue
+                if not token_is_max_context.get(start_index, False):
+                    continue
+                if end_index < start_index or end_index - start_index + 1 > max_answer_length:
+                    continue
+                prelim_predictions.append((feature_index, start_index, end_index,
+                                           start_logits[start_index], end_logits[end_index]))
+    prelim_predictions = sorted(prelim_predictions, key=lambda x: x[3] + x[4], reverse=True)
+
+    seen_predictions = set()
+    nbest = []
+    for (feature_index, start_index, end_index, start_logit, end_logit) in prelim_predictions:
+        if len(nbest) >= n_best_size:
+            break
+        feature = features[feature_index]
+        result = unique_id_to_result[feature.unique_id]
+        orig_doc_start = int(feature.token_to_orig_index[start_index - feature.doc_offset])
+        orig_doc_end = int(feature.token_to_orig_index[end_index - feature.doc_offset])
+        text = "".join(example.doc_tokens[orig_doc_start:orig_doc_end + 1])
+        if text in seen_predictions:
+            continue
+        seen_predictions.add(text)
+        nbest.append({
+            "text": text,
+            "start_logit": start_logit,
+            "end_logit": end_logit,
+            "start_prob": _compute_softmax([start_logit, float(result.end_logits[start_index])])[0],
+            "end_prob": _compute_softmax([float(result.start_logits[end_index]), end_logit])[1],
+            "start_prob_v1": _sigmoid(start_logit),
+            "end_prob_v1": _sigmoid(end_logit)})
+    probs = _compute_softmax([entry["start_logit"] + entry["end_logit"] for entry in nbest])
+    for (entry, prob) in zip(nbest, probs):
+        entry["probability"] = prob
+    return nbest
+
+
+@pytest.fixture
+def tokenizer(tmpdir):
+    vocab_file = tmpdir.join('vocab.txt')
+    vocab_file.write_text(u"\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + sorted(set(DOC_CHARS))),
+                          encoding='utf-8')
+    return BertTokenizer(str(vocab_file))
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('n_best_size,max_answer_length', [(5, 4), (20, 10)])
+def test_nbest_predictions(tokenizer, seed, n_best_size, max_answer_length):
+    rng = np.random.RandomState(seed)
+    # one char per doc token: every span has its own text, answers are compared as they are
+    doc_tokens = [DOC_CHARS[i] for i in rng.permutation(len(DOC_CHARS))]
+    example = BaiduExample(qas_id=seed, question_text=u"北京理工", doc_tokens=doc_tokens)
+    features = convert_examples_to_features([example], tokenizer, max_seq_length=24, doc_stride=6,
+                                            max_query_length=8, is_training=False)
+    assert len(features) > 2
+    unique_id_to_result = {}
+    for feature in features:
+        # distinct logits per window, on a 0.5 grid so that span scores (start + end) tie
+        start_logits = rng.permutation(len(feature.tokens)) * 0.5 - 5
+        end_logits = rng.permutation(len(feature.tokens)) * 0.5 - 5
+        unique_id_to_result[feature.unique_id] = RawResult(
+            unique_id=feature.unique_id,
+            start_logits=torch.tensor(start_logits.tolist(), dtype=torch.float32),
+            end_logits=torch.tensor(end_logits.tolist(), dtype=torch.float32))
+
+    expected = _loop_nbest(example, features, unique_id_to_result, n_best_size, max_answer_length)
+    nbest = _nbest_predictions(example, features, unique_id_to_result, n_best_size,
+                               max_answer_length, do_lower_case=True, verbose_logging=False)
+    assert [entry["text"] for entry in nbest] == [entry["text"] for entry in expected]
+    for (entry, expected_entry) in zip(nbest, expected):
+        for key in ["probability", "start_logit", "end_logit", "start_prob", "end_prob",
+                    "start_prob_v1", "end_prob_v1"]:
+            assert entry[key] == pytest.approx(expected_entry[key]), key
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+""" The one pass max context spans against the per token check they replaced. """
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+import pytest
+
+pytest.importorskip('torch')
+
+from mrc.utils_duqa import _max_context_span_indexes  # noqa: E402
+
+DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
+
+
+def _check_is_max_context(doc_spans, cur_span_index, position):
+    """The former per token check."""
+    best_score = None
+    best_span_index = None
+    for (span_index, doc_span) in enumerate(doc_spans):
+        end = doc_span.start + doc_span.length - 1
+        if position < doc_span.start:
+            continue
+        if position > end:
+            continue
+        num_left_context = position - doc_span.start
+        num_right_context = end - position
+        score = min(num_left_context, num_right_context) + 0.01 * doc_span.length
+        if best_score is None or score > best_score:
+            best_score = score
+            best_span_index = span_index
+    return cur_span_index == best_span_index
+
+
+def _sliding_doc_spans(num_tokens, max_tokens_for_doc, doc_stride):
+    """The windows of convert_examples_to_features."""
+    doc_spans = []
+    start_offset = 0
+    while start_offset < num_tokens:
+        length = min(num_tokens - start_offset, max_tokens_for_doc)
+        doc_spans.append(DocSpan(start=start_offset, length=length))
+        if start_offset + length == num_tokens:
+            break
+        start_offset += min(length, doc_stride)
+    return doc_spans
+
+
+@pytest.mark.parametrize('doc_spans', [
+    _sliding_doc_spans(13, 5, 2),
+    _sliding_doc_spans(13, 5, 5),
+    _sliding_doc_spans(100, 20, 7),
+    _sliding_doc_spans(101, 32, 16),
+    _sliding_doc_spans(4, 10, 3),
+    # uneven windows, a short one in the middle and ties between spans
+    [DocSpan(0, 6), DocSpan(2, 3), DocSpan(3, 6), DocSpan(4, 5)],
+], ids=['13-5-2', '13-5-5', '100-20-7', '101-32-16', 'single', 'uneven'])
+def test_max_context_span_indexes(doc_spans):
+    num_tokens = max(span.start + span.length for span in doc_spans)
+    best_span_index = _max_context_span_indexes(doc_spans, num_tokens)
+    for position in range(num_tokens):
+        for span_index in range(len(doc_spans)):
+            assert (best_span_index[position] == span_index) == \
+                _check_is_max_context(doc_spans, span_index, position), (position, span_index)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+""" FastWordPiece / basic_tokenize against the transformers BertTokenizer they replace. """
+
+from __future__ import absolute_import, division, print_function
+
+import pytest
+from transformers import BertTokenizer
+from transformers.tokenization_bert import BasicTokenizer
+
+from utils.tokenization import FastWordPiece, basic_tokenize, fast_tokenizer
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]",
+         "北", "京", "北京", "天", "安", "门", "的", "是", "##京", "##门",
+         "hello", "hell", "##o", "##lo", "he", "##ll", "world", "##s", "cafe", "##e",
+         "un", "##aff", "##able", ",", ".", "?", "1", "##2", "##3"]
+
+TEXTS = ["北京天安门", "北京的天安门是", "天坛", "Hello World", "HELLO, worlds?", "hellos",
+         "Café", "unaffable", "unaffable.", "123", "1 2 3", "x", "[UNK]", "北京[SEP]天安门",
+         "hello [MASK] world", " ", "\t", "", "a​b", "hello world",
+         "helloworldhelloworldhelloworldhelloworldhelloworldhelloworldhelloworldhelloworldhelloworldhelloworldx"]
+
+
+@pytest.fixture(params=[True, False], ids=['lower', 'cased'])
+def tokenizer(request, tmpdir):
+    vocab_file = tmpdir.join('vocab.txt')
+    vocab_file.write_text(u"\n".join(VOCAB), encoding='utf-8')
+    return BertTokenizer(str(vocab_file), do_lower_case=request.param)
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_same_sub_tokens_and_ids(tokenizer, text):
+    fast = FastWordPiece(tokenizer)
+    sub_tokens, ids = fast.tokenize_with_ids(text)
+    assert list(sub_tokens) == tokenizer.tokenize(text)
+    assert list(ids) == tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+    # memoized: same answer the second time
+    assert fast.tokenize(text) == tokenizer.tokenize(text)
+
+
+def test_fast_tokenizer_is_shared(tokenizer):
+    fast = fast_tokenizer(tokenizer)
+    assert fast is fast_tokenizer(tokenizer)
+    assert fast_tokenizer(fast) is fast
+    assert fast.vocab is tokenizer.vocab
+
+
+@pytest.mark.parametrize('do_lower_case', [True, False])
+def test_basic_tokenize(do_lower_case):
+    basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
+    for text in TEXTS + [" ".join(TEXTS), "北京  天安门 ", "a\tb c　d"]:
+        assert list(basic_tokenize(text, do_lower_case)) == basic_tokenizer.tokenize(text)
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+""" Utilities shared by the mrc, rerank, creeper and serving packages. """
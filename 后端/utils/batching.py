@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+""" Length-aware batching: pad each batch only to its own longest sequence. """
+
+from __future__ import absolute_import, division, print_function
+
+import torch
+from torch.utils.data import Sampler
+
+
+def pad_sequences(sequences, max_length=None, pad_value=0, dtype=torch.long):
+    """Stack variable-length lists into a [len(sequences), max_length] tensor, right-padded."""
+    if max_length is None:
+        max_length = max(len(seq) for seq in sequences)
+    tensor = torch.full((len(sequences), max_length), pad_value, dtype=dtype)
+    for i, seq in enumerate(sequences):
+        tensor[i, :len(seq)] = torch.tensor(seq[:max_length], dtype=dtype)
+    return tensor
+
+
+def trim_batch(batch, mask_index=1, num_sequences=3):
+    """
+    Cut the padding columns shared by the whole batch: the first `num_sequences`
+    tensors of `batch` are trimmed to the longest real length in `batch[mask_index]`.
+    """
+    max_length = int(batch[mask_index].sum(dim=1).max().item())
+    return tuple(t[:, :max_length] if i < num_sequences else t for i, t in enumerate(batch))
+
+
+class LengthSortedSampler(Sampler):
+    """Visit the dataset from the longest to the shortest sequence, so batches hold similar lengths."""
+
+    def __init__(self, lengths, descending=True):
+        self.order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=descending)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Training batches of similar lengths: every epoch the indices are shuffled, cut into
+    buckets of `bucket_size` batches, sorted by length inside each bucket and cut into
+    batches; the batches are then shuffled, so the order is random at batch level.
+    Combine with `trim_batch` to pad each batch only to its own longest sequence.
+
+    Like DistributedSampler, each of the `num_replicas` processes takes every
+    num_replicas-th batch (repeating a few so they all get the same number) and the
+    shuffling depends on the epoch: call `set_epoch` at the start of each one.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=100, num_replicas=None, rank=None, seed=0):
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        num_batches = (len(self.lengths) + batch_size - 1) // batch_size
+        self.num_batches = (num_batches + num_replicas - 1) // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)  # the same on every replica
+        order = torch.randperm(len(self.lengths), generator=generator)
+        batches = []
+        bucket_length = self.batch_size * self.bucket_size
+        for start in range(0, len(order), bucket_length):
+            bucket = order[start:start + bucket_length]
+            bucket = bucket[torch.argsort(self.lengths[bucket], descending=True)].tolist()
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        total = self.num_batches * self.num_replicas
+        batches += batches[:total - len(batches)]
+        return iter(batches[self.rank:total:self.num_replicas])
+
+    def __len__(self):
+        return self.num_batches
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+""" In-process and on-disk key/value caches. """
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import copy
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class CacheStats(object):
+    """Hit, miss and eviction counters."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def to_dict(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process LRU cache.
+
+    maxsize: max number of entries, the least recently used one is evicted first.
+    ttl: seconds an entry stays valid, None for no expiry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self._data[key]
+                self.stats.evictions += 1
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SqliteStore(object):
+    """Base of the SQLite backed stores: one connection per thread (and per process)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class SqliteCache(SqliteStore):
+    """
+    Pickled key/value cache in an SQLite file, shared by every process that
+    opens the same path. Connections are per thread (and per process).
+
+    ttl: seconds an entry stays valid, None for no expiry.
+    max_entries: when exceeded, the least recently read entries are evicted.
+    max_bytes: same, for the total size of the stored values.
+    compress: zlib-compress the pickled values.
+    """
+
+    def __init__(self, path, ttl=None, max_entries=None, max_bytes=None, compress=False):
+        super(SqliteCache, self).__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.stats = CacheStats()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)")
+
+    def get(self, key, default=None):
+        conn = self._connect()
+        row = conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is not None and row[1] is not None and row[1] < now:
+            with conn:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.stats.evictions += 1
+            row = None
+        if row is None:
+            self.stats.misses += 1
+            return default
+        with conn:
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        self.stats.hits += 1
+        blob = bytes(row[0])
+        if self.compress:
+            blob = zlib.decompress(blob)
+        return pickle.loads(blob)
+
+    def set(self, key, value):
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.compress:
+            blob = zlib.compress(blob)
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                         (key, sqlite3.Binary(blob), len(blob), expires, now))
+            self._evict(conn)
+
+    def delete(self, key):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _evict(self, conn):
+        if self.max_entries is not None:
+            count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute("DELETE FROM cache WHERE key IN "
+                             "(SELECT key FROM cache ORDER BY accessed LIMIT ?)", (count - self.max_entries,))
+                self.stats.evictions += count - self.max_entries
+        if self.max_bytes is not None:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            if total > self.max_bytes:
+                victims = []
+                for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+                    if total <= self.max_bytes:
+                        break
+                    victims.append((key,))
+                    total -= size
+                conn.executemany("DELETE FROM cache WHERE key = ?", victims)
+                self.stats.evictions += len(victims)
+
+
+class SingleFlight(object):
+    """
+    Deduplicate concurrent calls for the same key: the first caller runs the
+    function, the others wait for it and receive a copy of its result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event(), 'value': None, 'error': None}
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return copy.deepcopy(call['value'])
+        try:
+            call['value'] = fn()
+            return call['value']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+""" Resumable training checkpoints, written from CPU snapshots by a background thread. """
+
+from __future__ import absolute_import, division, print_function
+
+import glob
+import logging
+import os
+import queue
+import random
+import shutil
+import threading
+
+import numpy as np
+import torch
+from transformers import CONFIG_NAME, WEIGHTS_NAME
+
+logger = logging.getLogger(__name__)
+
+TRAINING_STATE_NAME = 'training_state.bin'
+EVALUATED_NAME = 'evaluated'  # empty marker, written by the eval worker once it is done with a checkpoint
+
+
+def _to_cpu(obj):
+    # clone: on CPU .cpu() returns the same storage, which the next optimizer step modifies
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((key, _to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def training_snapshot(model, optimizer, scheduler, **position):
+    """
+    CPU copies of everything needed to resume: weights, optimizer, scheduler, RNG states
+    and the position in the data (`position`: global_step, epoch, step, losses, ...).
+    Taken in the training loop, the writer thread then only touches the copies.
+    """
+    training_state = dict(position)
+    training_state['optimizer'] = _to_cpu(optimizer.state_dict())
+    training_state['scheduler'] = scheduler.state_dict()
+    training_state['rng'] = rng_state()
+    return {WEIGHTS_NAME: _to_cpu(model.state_dict()), TRAINING_STATE_NAME: training_state}
+
+
+def model_snapshot(model):
+    return {WEIGHTS_NAME: _to_cpu(model.state_dict())}
+
+
+def load_training_state(checkpoint_dir, model, optimizer, scheduler):
+    """Load a `training_snapshot` into model / optimizer / scheduler, returns the rest of the training state."""
+    model.load_state_dict(torch.load(os.path.join(checkpoint_dir, WEIGHTS_NAME), map_location='cpu'))
+    training_state = torch.load(os.path.join(checkpoint_dir, TRAINING_STATE_NAME), map_location='cpu')
+    optimizer.load_state_dict(training_state.pop('optimizer'))  # moved to the parameters' device
+    scheduler.load_state_dict(training_state.pop('scheduler'))
+    logger.info("Resuming from %s at global step %d", checkpoint_dir, training_state['global_step'])
+    return training_state
+
+
+def step_checkpoints(output_dir, prefix='checkpoint-'):
+    """The complete `<prefix><step>` directories of output_dir as sorted (step, path) pairs."""
+    checkpoints = []
+    for path in glob.glob(os.path.join(output_dir, prefix + '*')):
+        suffix = os.path.basename(path)[len(prefix):]
+        if suffix.isdigit() and os.path.exists(os.path.join(path, WEIGHTS_NAME)):
+            checkpoints.append((int(suffix), path))
+    return sorted(checkpoints)
+
+
+def mark_evaluated(checkpoint_dir):
+    open(os.path.join(checkpoint_dir, EVALUATED_NAME), 'w').close()
+
+
+def is_evaluated(checkpoint_dir):
+    return os.path.exists(os.path.join(checkpoint_dir, EVALUATED_NAME))
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread so the training loop only pays for the
+    CPU snapshot. A checkpoint is written to `<dir>.tmp` and renamed when complete:
+    a directory holding WEIGHTS_NAME is always a full checkpoint.
+    At most one checkpoint waits while another is written, `save` blocks beyond that.
+    With keep > 0 only the `keep` most recent `<prefix><step>` directories are kept;
+    with wait_for_eval, older ones are only deleted once the eval worker marked them
+    evaluated (see `mark_evaluated`), the next saves prune them.
+    """
+
+    def __init__(self, prefix='checkpoint-', keep=0, wait_for_eval=False):
+        self.prefix = prefix
+        self.keep = keep
+        self.wait_for_eval = wait_for_eval
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, output_dir, files, config=None, tokenizer=None):
+        """files: {file name: object to torch.save}, config / tokenizer are saved next to them."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put((output_dir, files, config, tokenizer))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(*item)
+            except Exception as e:  # raised in the training loop by the next save / close
+                logger.exception("Failed to write checkpoint %s", item[0])
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, output_dir, files, config, tokenizer):
+        tmp_dir = output_dir.rstrip('/') + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for name, obj in files.items():
+            torch.save(obj, os.path.join(tmp_dir, name))
+        if config is not None:
+            config.to_json_file(os.path.join(tmp_dir, CONFIG_NAME))
+        if tokenizer is not None:
+            tokenizer.save_vocabulary(tmp_dir)
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.rename(tmp_dir, output_dir)
+        logger.info("Saving model checkpoint to %s", output_dir)
+        if self.keep > 0:
+            self._prune(os.path.dirname(output_dir.rstrip('/')))
+
+    def _prune(self, parent_dir):
+        for _, path in step_checkpoints(parent_dir, self.prefix)[:-self.keep]:
+            if self.wait_for_eval and not is_evaluated(path):
+                continue
+            shutil.rmtree(path)
+
+    def close(self):
+        """Wait for the pending checkpoints."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def find_checkpoint(resume_from, output_dir, prefix='checkpoint-'):
+    """
+    The checkpoint to resume: resume_from itself, or with resume_from == 'latest'
+    the `<prefix><step>` directory of output_dir with the highest step.
+    """
+    if resume_from != 'latest':
+        checkpoint_dir = resume_from
+    else:
+        checkpoints = [path for (_, path) in step_checkpoints(output_dir, prefix)
+                       if os.path.exists(os.path.join(path, TRAINING_STATE_NAME))]
+        checkpoint_dir = checkpoints[-1] if checkpoints else None
+    if checkpoint_dir is None or not os.path.exists(os.path.join(checkpoint_dir, TRAINING_STATE_NAME)):
+        raise ValueError("No resumable checkpoint ({}) in {}".format(TRAINING_STATE_NAME, checkpoint_dir or output_dir))
+    return checkpoint_dir
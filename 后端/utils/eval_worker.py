@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+""" Evaluation of the training checkpoints in a separate process. """
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import multiprocessing
+import os
+
+from .checkpoint import mark_evaluated, step_checkpoints
+
+logger = logging.getLogger(__name__)
+
+
+def _watch(evaluate_fn, args, tokenizer, log_dir, prefix, start_step, poll_seconds, stop, parent_pid):
+    from tensorboardX import SummaryWriter
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    tb_writer = SummaryWriter(log_dir)
+    evaluated = set()
+    while True:
+        stopping = stop.is_set()  # checked before the scan: the last checkpoints are still evaluated
+        for global_step, checkpoint_dir in step_checkpoints(args.output_dir, prefix):
+            if global_step in evaluated:
+                continue
+            evaluated.add(global_step)
+            if global_step > start_step:
+                try:
+                    results = evaluate_fn(args, checkpoint_dir, tokenizer, global_step)
+                except Exception:
+                    logger.exception("Could not evaluate %s", checkpoint_dir)
+                else:
+                    for key, value in results.items():
+                        tb_writer.add_scalar('eval_{}'.format(key), value, global_step)
+            mark_evaluated(checkpoint_dir)  # the checkpoint writer may prune it now
+        if stopping or os.getppid() != parent_pid:
+            break
+        stop.wait(poll_seconds)
+    tb_writer.close()
+
+
+class EvalWorker(object):
+    """
+    Evaluates the `<prefix><step>` checkpoints of args.output_dir as they appear, in a
+    spawned process, so training never waits for evaluation.
+    evaluate_fn(args, checkpoint_dir, tokenizer, global_step) must be a module level
+    function returning {name: value}; the values are logged to the tensorboard
+    directory log_dir (the one of the training run) at global_step.
+    Checkpoints up to start_step (a resumed run) are not evaluated again. Every
+    checkpoint is marked evaluated afterwards, see AsyncCheckpointWriter(wait_for_eval=True).
+    """
+
+    def __init__(self, evaluate_fn, args, tokenizer, log_dir, prefix='checkpoint-', start_step=0, poll_seconds=30):
+        context = multiprocessing.get_context('spawn')  # no CUDA state inherited from the trainer
+        self._stop = context.Event()
+        self._process = context.Process(target=_watch, name='eval-worker',
+                                        args=(evaluate_fn, args, tokenizer, log_dir, prefix, start_step,
+                                              poll_seconds, self._stop, os.getpid()))
+        self._process.start()
+        logger.info("Evaluating the checkpoints of %s in process %d", args.output_dir, self._process.pid)
+
+    def close(self):
+        """Wait for the worker to evaluate the last checkpoints."""
+        self._stop.set()
+        self._process.join()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+""" Cached features as memory-mapped fixed-width columns, one .npy file per column. """
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+META_NAME = 'meta.json'
+
+
+def ids_dtype(vocab_size):
+    """Narrowest integer type holding every token id (int16 for the 21128 chinese BERT vocab)."""
+    return np.int16 if vocab_size <= np.iinfo(np.int16).max + 1 else np.int32
+
+
+def store_dir(cached_features_file):
+    return cached_features_file + '.store'
+
+
+def has_feature_store(directory):
+    # meta.json is written last: a store interrupted while writing is not picked up
+    return os.path.exists(os.path.join(directory, META_NAME))
+
+
+def _column_shape(features, attribute, max_seq_length):
+    first = getattr(features[0], attribute) if features else None
+    return (len(features), max_seq_length) if first is not None and np.ndim(first) > 0 else (len(features),)
+
+
+def _fill_column(array, features, attribute):
+    if array.ndim == 2:
+        array[:] = 0
+        for i, feature in enumerate(features):
+            value = getattr(feature, attribute)
+            array[i, :len(value)] = value
+    else:
+        array[:] = [-1 if getattr(feature, attribute) is None else getattr(feature, attribute)
+                    for feature in features]
+
+
+def _extra_file(directory, name):
+    return os.path.join(directory, name + '.bin')
+
+
+def write_feature_store(directory, features, columns, max_seq_length, extras=None):
+    """
+    Write `features` column by column: `columns` is a list of (attribute, dtype),
+    sequence attributes become [num_features, max_seq_length] arrays right-padded with 0,
+    scalar attributes (None counts as -1) become [num_features] arrays.
+    extras: {name: object} that does not fit in columns, torch.save'd next to them.
+    """
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    meta = {'num_features': len(features), 'max_seq_length': max_seq_length, 'columns': []}
+    for (name, dtype) in columns:
+        shape = _column_shape(features, name, max_seq_length)
+        array = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+',
+                                          dtype=dtype, shape=shape)
+        _fill_column(array, features, name)
+        array.flush()
+        del array
+        meta['columns'].append({'name': name, 'dtype': np.dtype(dtype).str, 'shape': list(shape)})
+    for name, obj in (extras or {}).items():
+        torch.save(obj, _extra_file(directory, name))
+    with open(os.path.join(directory, META_NAME), 'w') as f:
+        json.dump(meta, f)
+    logger.info("Wrote %d features to %s", len(features), directory)
+
+
+def feature_tensors(features, columns, max_seq_length, names):
+    """The same tensors as `load_feature_store`, built in memory (no store written)."""
+    dtypes = dict(columns)
+    tensors = []
+    for name in names:
+        array = np.empty(_column_shape(features, name, max_seq_length), dtype=dtypes[name])
+        _fill_column(array, features, name)
+        tensors.append(torch.from_numpy(array))
+    return tensors
+
+
+def load_feature_store(directory, names):
+    """
+    The columns `names` as tensors over the mapped files, no copy: the arrays keep their
+    narrow types, cast the batches with `.long()` once on the device.
+    Mapped copy-on-write, so the files are never modified.
+    """
+    with open(os.path.join(directory, META_NAME)) as f:
+        meta = json.load(f)
+    columns = {column['name'] for column in meta['columns']}
+    tensors = []
+    for name in names:
+        if name not in columns:
+            raise ValueError("{} has no column {}, delete it to rebuild the cache".format(directory, name))
+        tensors.append(torch.from_numpy(np.load(os.path.join(directory, name + '.npy'), mmap_mode='c')))
+    logger.info("Mapped %d features from %s", meta['num_features'], directory)
+    return tensors
+
+
+def has_feature_extra(directory, name):
+    return has_feature_store(directory) and os.path.exists(_extra_file(directory, name))
+
+
+def load_feature_extra(directory, name):
+    """An object of the `extras` of write_feature_store."""
+    if not has_feature_extra(directory, name):
+        raise ValueError("{} has no {}, delete it to rebuild the cache".format(directory, name))
+    return torch.load(_extra_file(directory, name))
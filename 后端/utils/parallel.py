@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+""" Ordered, chunked map over a process pool for the feature conversion. """
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import multiprocessing
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+_worker_fn = None
+_worker_kwargs = None
+
+
+def _init_worker(fn, kwargs):
+    # the shared arguments (tokenizer, ...) are sent once per worker, not once per chunk
+    global _worker_fn, _worker_kwargs
+    _worker_fn = fn
+    _worker_kwargs = kwargs
+
+
+def _run_chunk(chunk_and_offset):
+    chunk, offset = chunk_and_offset
+    return _worker_fn(chunk, offset, **_worker_kwargs)
+
+
+def map_chunks(fn, items, num_workers=1, chunk_size=256, desc=None, **kwargs):
+    """
+    fn(chunk, offset, **kwargs) on consecutive chunks of items, offset being the
+    index of the chunk's first item. Returns the concatenated results in item order.
+    fn must be a module level function (it is pickled for the workers).
+    """
+    chunks = [(items[i:i + chunk_size], i) for i in range(0, len(items), chunk_size)]
+    if num_workers <= 1 or len(chunks) <= 1:
+        results = [fn(chunk, offset, **kwargs) for (chunk, offset) in tqdm(chunks, desc=desc, disable=len(chunks) <= 1)]
+    else:
+        logger.info("Converting %d items in %d chunks on %d processes", len(items), len(chunks), num_workers)
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(fn, kwargs))
+        try:
+            results = list(tqdm(pool.imap(_run_chunk, chunks), total=len(chunks), desc=desc))
+        finally:
+            pool.close()
+            pool.join()
+    return [result for chunk_results in results for result in chunk_results]
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+""" Streaming training input: JSONL shards -> shuffled training tensors, built on the fly. """
+
+from __future__ import absolute_import, division, print_function
+
+import glob
+import json
+import logging
+import random
+from io import open
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+logger = logging.getLogger(__name__)
+
+
+def list_shards(pattern):
+    """The files matching a glob pattern (or the single file), sorted so every process sees the same list."""
+    files = sorted(glob.glob(pattern))
+    if not files:
+        raise ValueError("No training file matches {}".format(pattern))
+    return files
+
+
+class JsonlStream(IterableDataset):
+    """
+    Endless stream over JSONL shards: each line goes through build_fn(json, **build_kwargs),
+    which returns a list of training items (tuples of int lists / ints, all of the same
+    shape across items), yielded as long tensors through a shuffle buffer.
+
+    Every (distributed rank, DataLoader worker) pair reads its own part of the data:
+    whole shards when there are enough of them, every n-th line otherwise. Each pass
+    (epoch) shuffles the shard order and the buffer with seeds derived from `seed`,
+    the pass number and the reader, so a run is reproducible for a given world size
+    and number of workers. The stream never ends, the training loop stops at max_steps.
+    """
+
+    def __init__(self, files, build_fn, shuffle_buffer_size=10000, seed=42, rank=0, world_size=1,
+                 **build_kwargs):
+        self.files = list(files)
+        self.build_fn = build_fn
+        self.shuffle_buffer_size = max(1, shuffle_buffer_size)
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.build_kwargs = build_kwargs
+
+    def _reader(self):
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        return self.rank * num_workers + worker_id, self.world_size * num_workers
+
+    def _lines(self, epoch, reader_id, num_readers):
+        files = list(self.files)
+        random.Random('{}-{}'.format(self.seed, epoch)).shuffle(files)  # same order for every reader
+        if len(files) >= num_readers:
+            for input_file in files[reader_id::num_readers]:
+                with open(input_file, 'r', encoding='utf-8') as reader:
+                    for line in reader:
+                        yield line
+        else:
+            line_index = 0
+            for input_file in files:
+                with open(input_file, 'r', encoding='utf-8') as reader:
+                    for line in reader:
+                        if line_index % num_readers == reader_id:
+                            yield line
+                        line_index += 1
+
+    def _items(self, epoch, reader_id, num_readers):
+        for line in self._lines(epoch, reader_id, num_readers):
+            if not line.strip():
+                continue
+            for item in self.build_fn(json.loads(line), **self.build_kwargs):
+                yield item
+
+    def __iter__(self):
+        reader_id, num_readers = self._reader()
+        epoch = 0
+        while True:
+            rng = random.Random('{}-{}-{}'.format(self.seed, epoch, reader_id))
+            buffer = []
+            for item in self._items(epoch, reader_id, num_readers):
+                if len(buffer) < self.shuffle_buffer_size:
+                    buffer.append(item)
+                    continue
+                index = rng.randrange(self.shuffle_buffer_size)
+                yield tuple(torch.tensor(value, dtype=torch.long) for value in buffer[index])
+                buffer[index] = item
+            if not buffer and epoch == 0:
+                raise ValueError("Reader {}/{} got no training item from {}".format(reader_id, num_readers, self.files))
+            rng.shuffle(buffer)
+            for item in buffer:
+                yield tuple(torch.tensor(value, dtype=torch.long) for value in item)
+            epoch += 1
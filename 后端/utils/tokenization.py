@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+""" Memoized, trie based WordPiece tokenization, same output as BertTokenizer.tokenize. """
+
+from __future__ import absolute_import, division, print_function
+
+import functools
+import logging
+import weakref
+
+from transformers.tokenization_bert import BasicTokenizer
+
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+_END = None  # trie key of the vocab piece ending at a node
+
+
+def _build_trie(pieces):
+    root = {}
+    for piece in pieces:
+        node = root
+        for c in piece:
+            node = node.setdefault(c, {})
+        node[_END] = True
+    return root
+
+
+class FastWordPiece(object):
+    """
+    Wraps a BertTokenizer: `tokenize` / `tokenize_with_ids` are memoized per text
+    (jieba tokens repeat a lot) and the WordPiece step walks a vocab trie instead
+    of trying every substring. Everything else is delegated to the wrapped tokenizer,
+    so it can be passed wherever the tokenizer was.
+    """
+
+    def __init__(self, tokenizer, cache_size=100000):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._init_tables()
+
+    def _init_tables(self):
+        tokenizer = self.tokenizer
+        # at the start of a word the raw vocab entry is looked up, after that "##" + rest
+        self._word_trie = _build_trie(tokenizer.vocab)
+        self._suffix_trie = _build_trie(piece[2:] for piece in tokenizer.vocab if piece.startswith("##"))
+        self._unk_id = tokenizer.vocab.get(tokenizer.unk_token)
+        self._special_tokens = list(tokenizer.added_tokens_encoder) + tokenizer.all_special_tokens
+        self._cache = LRUCache(maxsize=self.cache_size)
+
+    def __getstate__(self):
+        # sent to the feature conversion workers: tables are rebuilt there
+        return {'tokenizer': self.tokenizer, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_tables()
+
+    def __getattr__(self, name):
+        if name == 'tokenizer':
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def _wordpiece(self, token):
+        wordpiece_tokenizer = self.tokenizer.wordpiece_tokenizer
+        if len(token) > wordpiece_tokenizer.max_input_chars_per_word:
+            return [wordpiece_tokenizer.unk_token]
+        sub_tokens = []
+        trie = self._word_trie
+        start = 0
+        while start < len(token):
+            # greedy longest match: the last vocab piece seen walking down the trie
+            node = trie
+            end = None
+            pos = start
+            while pos < len(token):
+                node = node.get(token[pos])
+                if node is None:
+                    break
+                pos += 1
+                if _END in node:
+                    end = pos
+            if end is None:
+                return [wordpiece_tokenizer.unk_token]
+            sub_tokens.append(token[start:end] if start == 0 else "##" + token[start:end])
+            start = end
+            trie = self._suffix_trie
+        return sub_tokens
+
+    def _tokenize(self, text):
+        tokenizer = self.tokenizer
+        if not text.strip() or any(special in text for special in self._special_tokens):
+            # special / added tokens are split out by PreTrainedTokenizer.tokenize, which
+            # also turns a whitespace only text into a special token: keep its exact output
+            return tokenizer.tokenize(text)
+        if not tokenizer.do_basic_tokenize:
+            words = text.split()
+        else:
+            words = tokenizer.basic_tokenizer.tokenize(text, never_split=tokenizer.all_special_tokens)
+        sub_tokens = []
+        for word in words:
+            for token in word.split():
+                sub_tokens.extend(self._wordpiece(token))
+        return sub_tokens
+
+    def tokenize_with_ids(self, text):
+        """(sub_tokens, ids) of text, both tuples."""
+        result = self._cache.get(text)
+        if result is None:
+            sub_tokens = tuple(self._tokenize(text))
+            ids = tuple(self.tokenizer.vocab.get(token, self._unk_id) for token in sub_tokens)
+            result = (sub_tokens, ids)
+            self._cache.set(text, result)
+        return result
+
+    def tokenize(self, text, **kwargs):
+        return list(self.tokenize_with_ids(text)[0])
+
+
+_fast_tokenizers = weakref.WeakKeyDictionary()
+
+
+def fast_tokenizer(tokenizer):
+    """The FastWordPiece of a BertTokenizer, one per tokenizer (and process)."""
+    if isinstance(tokenizer, FastWordPiece):
+        return tokenizer
+    if not hasattr(tokenizer, 'wordpiece_tokenizer'):
+        return tokenizer
+    fast = _fast_tokenizers.get(tokenizer)
+    if fast is None:
+        fast = FastWordPiece(tokenizer)
+        _fast_tokenizers[tokenizer] = fast
+    return fast
+
+
+@functools.lru_cache(maxsize=2)
+def _basic_tokenizer(do_lower_case):
+    return BasicTokenizer(do_lower_case=do_lower_case)
+
+
+@functools.lru_cache(maxsize=100000)
+def _basic_tokenize_piece(piece, do_lower_case):
+    return tuple(_basic_tokenizer(do_lower_case).tokenize(piece))
+
+
+def basic_tokenize(text, do_lower_case):
+    """
+    BasicTokenizer(do_lower_case).tokenize(text), memoized per space separated piece:
+    texts are joined jieba tokens, which repeat a lot while whole texts do not.
+    BasicTokenizer splits on spaces anyway, so the pieces tokenize independently.
+    """
+    tokens = []
+    for piece in text.split(" "):
+        if piece:
+            tokens.extend(_basic_tokenize_piece(piece, do_lower_case))
+    return tuple(tokens)
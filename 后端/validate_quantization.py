@@ -0,0 +1,99 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import torch
+
+from models.quantization import load_quantized
+from mrc import mrc_evaluate, mrc_MODEL_CLASSES, set_seed
+from mrc.metrics import score_predictions, write_references
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Args(object):
+    def __init__(self, config):
+        for key, value in config.items():
+            self.__dict__[key] = value
+
+
+def write_subset(predict_file, output_dir, num_examples):
+    """First num_examples lines of the dev file, plus a reference file in the mrc_eval format."""
+    subset_file = os.path.join(output_dir, 'dev_subset.json')
+    seen = set()
+    with open(predict_file, 'r', encoding='utf-8') as reader, \
+            open(subset_file, 'w', encoding='utf-8') as subset:
+        for line in reader:
+            if len(seen) >= num_examples:
+                break
+            example = json.loads(line)
+            if example['question_id'] in seen:
+                continue
+            seen.add(example['question_id'])
+            subset.write(line if line.endswith('\n') else line + '\n')
+    return subset_file, write_references(subset_file, os.path.join(output_dir, 'ref.json'))
+
+
+def run(args, model, tokenizer, name, ref_file):
+    """mrc_evaluate one model, then score its predictions with ROUGE-L / BLEU-4."""
+    args.output_dir = os.path.join(args.validate_dir, name)
+    start = time.time()
+    predictions = mrc_evaluate(args, model, tokenizer, prefix=name)
+    elapsed = time.time() - start
+
+    scores = score_predictions(predictions, ref_file, args.output_dir)
+    scores['seconds'] = round(elapsed, 2)
+    return scores, predictions
+
+
+if __name__ == "__main__":
+    """
+    python validate_quantization.py --num_examples=300
+    Compare the int8 MRC model with fp32 on a dev subset before turning on "quantize" in the config.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default='eval_config.json', type=str)
+    parser.add_argument("--num_examples", default=300, type=int)
+    parser.add_argument("--output_dir", default='results/quantization', type=str)
+    parser.add_argument("--max_drop", default=0.5, type=float,
+                        help="Max ROUGE-L drop (points) accepted for the int8 model")
+    cmd_args = parser.parse_args()
+
+    args = Args(json.load(open(cmd_args.config, 'r'))['mrc'])
+    # int8 kernels are CPU only, fp32 runs on CPU too so the timings are comparable
+    args.device = torch.device('cpu')
+    args.n_gpu = 0
+    args.local_rank = -1
+    args.overwrite_cache = False
+    args.validate_dir = cmd_args.output_dir
+    set_seed(args)
+    os.makedirs(cmd_args.output_dir, exist_ok=True)
+    args.predict_file, ref_file = write_subset(args.predict_file, cmd_args.output_dir, cmd_args.num_examples)
+
+    config_class, model_class, tokenizer_class = mrc_MODEL_CLASSES[args.model_type]
+    config = config_class.from_pretrained(args.model_name_or_path)
+    tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path, do_lower_case=args.do_lower_case)
+
+    fp32_model = model_class.from_pretrained(args.model_name_or_path, config=config)
+    fp32_scores, fp32_predictions = run(args, fp32_model, tokenizer, 'fp32', ref_file)
+    del fp32_model
+    int8_model = load_quantized(args.model_name_or_path, model_class, config)
+    int8_scores, int8_predictions = run(args, int8_model, tokenizer, 'int8', ref_file)
+
+    same = sum(1 for qid, text in fp32_predictions.items() if int8_predictions.get(qid) == text)
+    logger.info("fp32: %s", fp32_scores)
+    logger.info("int8: %s", int8_scores)
+    logger.info("delta ROUGE-L %.2f, BLEU-4 %.2f, speedup %.2fx, identical answers %d/%d",
+                int8_scores['ROUGE-L'] - fp32_scores['ROUGE-L'],
+                int8_scores['BLEU-4'] - fp32_scores['BLEU-4'],
+                fp32_scores['seconds'] / max(int8_scores['seconds'], 1e-6),
+                same, len(fp32_predictions))
+    if fp32_scores['ROUGE-L'] - int8_scores['ROUGE-L'] > cmd_args.max_drop:
+        logger.warning("ROUGE-L drop exceeds %.2f, keep \"quantize\": false", cmd_args.max_drop)
+        sys.exit(1)